@@ -1,16 +1,20 @@
+import time
+SCRIPT_STARTED = time.perf_counter()
 import streamlit as st
-import pymongo
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 import calendar
-from streamlit_quill import st_quill
-from streamlit_drawable_canvas import st_canvas
-from PIL import Image
 import io
-import time
 import uuid
-import bson.binary
 import json
-import re
+from repository import virtual_day_note, DASHBOARD_PAGE_SIZE
+from storage import open_repository
+from cache import QueryCache
+from render import process_content_for_display, flatten_formulas_to_text
+import writequeue
+import perf
+from trash import TRASH_RETENTION_DAYS, purge_expired, start_purger
+from collections import deque
+from recurrence import parse_rrule, series_fields, describe
 
 # --- 1. PAGE CONFIGURATION ---
 st.set_page_config(page_title="DOR NOTES", page_icon="📄", layout="wide")
@@ -19,6 +23,7 @@ st.set_page_config(page_title="DOR NOTES", page_icon="📄", layout="wide")
 if 'text_size' not in st.session_state: st.session_state.text_size = "16px"
 if 'edit_trigger' not in st.session_state: st.session_state.edit_trigger = 0
 if 'create_key' not in st.session_state: st.session_state.create_key = str(uuid.uuid4())
+if 'pending_saves' not in st.session_state: st.session_state.pending_saves = []
 
 # States for Calendar
 if 'cal_create_date' not in st.session_state: st.session_state.cal_create_date = None
@@ -27,20 +32,24 @@ if 'cal_month' not in st.session_state: st.session_state.cal_month = datetime.no
 
 # Settings Defaults
 if 'grid_cols' not in st.session_state: st.session_state.grid_cols = 4
-if 'auto_clean_enabled' not in st.session_state: st.session_state.auto_clean_enabled = True
 if 'reset_counter' not in st.session_state: st.session_state.reset_counter = 0
+if 'dash_pages' not in st.session_state: st.session_state.dash_pages = 1
+if 'perf_enabled' not in st.session_state: st.session_state.perf_enabled = False
+if 'perf_runs' not in st.session_state: st.session_state.perf_runs = deque(maxlen=perf.MAX_RUNS)
+
+# Performance panel (opt-in, Settings): this rerun's storage ops and timers are recorded from here on
+if st.session_state.perf_enabled: perf.start_run(st.session_state.perf_runs)
+else: perf.stop_recording()
 
 # Canvas Defaults
 if 'canvas_w' not in st.session_state: st.session_state.canvas_w = 600
 if 'canvas_h' not in st.session_state: st.session_state.canvas_h = 400
 
 # --- 3. JAVASCRIPT SWIPE ---
+# Runs in the parent page (see inject_static_assets), not in the component iframe: Streamlit removes
+# the iframe on the next rerun, and a detached iframe's callbacks no longer fire
 swipe_js = """
-<script>
-    var doc = window.parent.document;
-    doc.addEventListener('touchstart', handleTouchStart, false);
-    doc.addEventListener('touchmove', handleTouchMove, false);
-
+(function () {
     var xDown = null;
     var yDown = null;
 
@@ -58,7 +67,7 @@ swipe_js = """
         var yDiff = yDown - yUp;
 
         if (Math.abs(xDiff) > Math.abs(yDiff)) { 
-            var tabs = doc.querySelectorAll('button[data-baseweb="tab"]');
+            var tabs = document.querySelectorAll('button[data-baseweb="tab"]');
             if (tabs.length >= 2) {
                 if (xDiff > 0) { tabs[1].click(); } else { tabs[0].click(); }
             }
@@ -66,13 +75,15 @@ swipe_js = """
         xDown = null;
         yDown = null;
     };
-</script>
+
+    document.addEventListener('touchstart', handleTouchStart, false);
+    document.addEventListener('touchmove', handleTouchMove, false);
+})();
 """
-st.components.v1.html(swipe_js, height=0)
 
 # --- 4. CSS AESTHETIC & MOBILE OPTIMIZATION ---
-st.markdown(f"""
-<style>
+def build_css(text_size):
+    return f"""
     /* --- ANIMATION --- */
     @keyframes tracking-in-contract {{
         0% {{ letter-spacing: 15px; opacity: 0; }}
@@ -102,9 +113,9 @@ st.markdown(f"""
     /* EXPANDER */
     .streamlit-expander {{ border-radius: 12px !important; border: 1px solid #e0e0e0 !important; box-shadow: 0 2px 5px rgba(0,0,0,0.03); background-color: white; margin-bottom: 10px; }}
     .streamlit-expanderHeader {{ font-weight: 600; font-size: 1.0rem; background-color: #fff; border-radius: 12px 12px 0 0; padding: 0.5rem !important; }}
-    .streamlit-expanderContent {{ border-top: 1px solid #f8f8f8; font-size: {st.session_state.text_size}; padding-top: 10px; border-radius: 0 0 12px 12px; }}
+    .streamlit-expanderContent {{ border-top: 1px solid #f8f8f8; font-size: {text_size}; padding-top: 10px; border-radius: 0 0 12px 12px; }}
     
-    .quill-read-content {{ font-size: {st.session_state.text_size} !important; font-family: 'Georgia', serif; line-height: 1.6; }}
+    .quill-read-content {{ font-size: {text_size} !important; font-family: 'Georgia', serif; line-height: 1.6; }}
     .quill-read-content a {{ color: #1E90FF !important; text-decoration: underline !important; cursor: pointer !important; }}
 
     .dor-badge {{ display: inline-block; background-color: #f0f0f0; color: #333; border: 1px solid #ddd; padding: 2px 8px; border-radius: 12px; font-size: 0.75rem; font-weight: 600; letter-spacing: 0.5px; text-transform: uppercase; }}
@@ -203,67 +214,186 @@ st.markdown(f"""
              flex: 1 1 50% !important;
         }}
     }}
-</style>
-""", unsafe_allow_html=True)
+"""
 
-# --- 5. INIT & DB ---
-if 'first_load' not in st.session_state:
-    splash = st.empty()
-    with splash.container():
-        st.markdown("<div class='splash-text'>DOR NOTES</div>", unsafe_allow_html=True)
-        time.sleep(1.5)
-    splash.empty()
-    st.session_state['first_load'] = True
+def inject_static_assets():
+    # CSS and swipe JS are sent once per session (again only when the text size changes) instead of on
+    # every rerun: the script copies both into the page head, where they stay after the component
+    # iframe is gone. The swipe <script> is added once per page and runs there, in the page's own realm
+    if st.session_state.get("assets_for") == st.session_state.text_size: return
+    st.components.v1.html(f"""<script>
+    var doc = window.parent.document;
+    var css = doc.getElementById('dor-css') || doc.head.appendChild(doc.createElement('style'));
+    css.id = 'dor-css';
+    css.textContent = {json.dumps(build_css(st.session_state.text_size))};
+    if (!doc.getElementById('dor-swipe')) {{
+        var swipe = doc.createElement('script');
+        swipe.id = 'dor-swipe';
+        swipe.textContent = {json.dumps(swipe_js)};
+        doc.head.appendChild(swipe);
+    }}
+    </script>""", height=0)
+    st.session_state.assets_for = st.session_state.text_size
 
+inject_static_assets()
+
+# --- 5. INIT & DB ---
 if 'editor_key' not in st.session_state:
     st.session_state.editor_key = str(uuid.uuid4())
 
-@st.cache_resource
-def init_connection():
-    try:
-        return pymongo.MongoClient(st.secrets["mongo"]["connection_string"])
-    except Exception:
-        return None
-
-client = init_connection()
-if client is None: st.stop()
-db = client.diario_db
-collection = db.note
+@st.cache_resource(show_spinner=False)
+def init_repository():
+    # Once per process: pick the backend, then indexes/schema and pending migrations;
+    # every note read/write goes through repo. A failure raises, so it isn't cached and the next run retries
+    try: settings = st.secrets.to_dict()
+    except Exception: settings = {}
+    repo = open_repository(settings)
+    repo.ensure_ready()
+    start_purger(repo)
+    return repo
+
+# The splash covers only real work: a new session's first run while the repository is being opened
+splash = st.empty()
+if 'first_load' not in st.session_state:
+    with splash.container(): st.markdown("<div class='splash-text'>DOR NOTES</div>", unsafe_allow_html=True)
+try: repo = init_repository()
+except Exception as e:
+    splash.empty()
+    # Only the error type: messages can quote the connection string
+    st.error(f"Could not open the notes database ({type(e).__name__}). Check the [mongo] or [storage] secrets.")
+    st.stop()
+splash.empty()
+if 'query_cache' not in st.session_state: st.session_state.query_cache = QueryCache()
 
 # --- 6. UTILS ---
-def ensure_custom_order():
-    count_missing = collection.count_documents({"custom_order": {"$exists": False}})
-    if count_missing > 0:
-        all_notes = list(collection.find().sort("data", 1))
-        for index, note in enumerate(all_notes):
-            collection.update_one({"_id": note["_id"]}, {"$set": {"custom_order": index}})
-
-ensure_custom_order()
-
-def convert_notes_to_json(note_list):
-    export_list = []
-    for nota in note_list:
-        nota_export = nota.copy()
-        nota_export['_id'] = str(nota['_id'])
-        nota_export['data'] = nota['data'].strftime("%Y-%m-%d %H:%M:%S")
-        if 'file_data' in nota_export: del nota_export['file_data']
-        if 'drawing_json' in nota_export: del nota_export['drawing_json']
-        export_list.append(nota_export)
-    return json.dumps(export_list, indent=4)
-
-def process_content_for_display(html_content):
-    if not html_content: return ""
-    html_content = re.sub(r'<a href="(.*?)"', r'<a href="\1" target="_blank" style="color: #1E90FF !important; text-decoration: underline !important; cursor: pointer;" rel="noopener noreferrer"', html_content)
-    html_content = html_content.replace('<span class="ql-ui" contenteditable="false"></span>', '')
-    html_content = re.sub(r'<li data-list="unchecked">(.*?)</li>', r'<div style="display: flex; align-items: flex-start; margin-bottom: 4px; margin-left: 5px;"><span style="margin-right: 10px; font-size: 1.2em; color: #555; line-height: 1.2;">&#9744;</span><span>\1</span></div>', html_content, flags=re.DOTALL)
-    html_content = re.sub(r'<li data-list="checked">(.*?)</li>', r'<div style="display: flex; align-items: flex-start; margin-bottom: 4px; margin-left: 5px; color: #888; text-decoration: line-through;"><span style="margin-right: 10px; font-size: 1.2em; color: #333; text-decoration: none; line-height: 1.2;">&#9745;</span><span>\1</span></div>', html_content, flags=re.DOTALL)
-    html_content = html_content.replace('<ul>', '').replace('</ul>', '')
-    return html_content
-
-def flatten_formulas_to_text(html_content):
-    if not html_content: return ""
-    pattern = r'<span class="ql-formula"[^>]*?data-value="(?P<formula>.+?)"[^>]*?>.*?</span>'
-    return re.sub(pattern, r' $$\g<formula>$$ ', html_content, flags=re.DOTALL)
+
+# Editor, canvas and PIL (with numpy) are imported on first use, not on a session's first run
+def st_quill(**kwargs):
+    from streamlit_quill import st_quill as quill
+    return quill(**kwargs)
+
+def st_canvas(**kwargs):
+    from streamlit_drawable_canvas import st_canvas as canvas
+    return canvas(**kwargs)
+
+def save_drawing(image_data, write):
+    from drawings import save_drawing as save
+    return save(image_data, write)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def load_thumb(blob_id):
+    # Thumbnails only: at most THUMB_MAX_SIDE wide, so the cache stays a few MB. Blobs are
+    # content-addressed, so an entry can never go stale. Full files are never cached here.
+    return repo.read_blob(blob_id)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_trash_auto_clean():
+    # Shared by every session like the stats; cleared when the toggle changes it
+    return repo.trash_auto_clean()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_storage_stats():
+    # Counted and sized by the server; only a handful of group rows come back
+    return repo.storage_stats()
+
+def cached_read(method, *args, **kwargs):
+    # Per-session memo of repo reads, keyed by method and arguments (search text, month...).
+    # Every write through repo bumps repo.generation, which invalidates all entries at once.
+    # Cached lists are shared across reruns: never mutate them in place.
+    key = (method.__name__, args, tuple(sorted(kwargs.items())))
+    return st.session_state.query_cache.get_or_load(key, repo.generation, lambda: method(*args, **kwargs))
+
+def render_note_image(note, key):
+    # Lists show the small thumbnail made at save time; the full image is fetched and decoded on request
+    flag = f"full_{key}"
+    thumb = load_thumb(note.get("thumb_id")) if note.get("thumb_id") else None
+    if thumb and not st.session_state.get(flag):
+        if not st.button("⤢ Full size", key=f"fs_{key}"):
+            with perf.timer("image decode"): st.image(thumb)
+            return
+        st.session_state[flag] = True
+    file_bytes = repo.read_blob(note.get("file_id"))
+    if file_bytes:
+        try:
+            from PIL import Image
+            with perf.timer("image decode"): st.image(Image.open(io.BytesIO(file_bytes)))
+        except: pass
+
+def track_save(label, future):
+    # Uploads and drawings are written by writequeue workers; watch_pending_saves reports the outcome
+    st.session_state.pending_saves.append((label or "Untitled", future))
+    return "pending"
+
+@st.fragment(run_every=1)
+def watch_pending_saves():
+    # Pending notes are shown right away; each finished save is toasted and the app rerun to show the real note
+    done = [(label, f) for label, f in st.session_state.pending_saves if f.done()]
+    for label, future in done:
+        if future.exception(): st.toast(f"Could not save '{label}': {future.exception()}", icon="⚠️")
+        else: st.toast(f"Saved '{label}'", icon="✅")
+    st.session_state.pending_saves = [(label, f) for label, f in st.session_state.pending_saves if not f.done()]
+    if done: st.rerun()
+    for label, _ in st.session_state.pending_saves:
+        st.caption(f"⏳ **{label}** saving...")
+
+@perf.timed("dashboard query")
+def load_dashboard(query, pages):
+    # Returns the notes of the first 'pages' pages and whether there are more.
+    # Browsing walks keyset pages; a search is ranked by relevance and loads only the pages shown (plus one note).
+    if query:
+        shown = pages * DASHBOARD_PAGE_SIZE
+        notes = cached_read(repo.dashboard_notes, query, limit=shown + 1)
+        return notes[:shown], len(notes) > shown
+    notes, cursor = [], None
+    for _ in range(pages):
+        page, cursor = cached_read(repo.dashboard_page, cursor)
+        notes += page
+        if cursor is None: break
+    return notes, cursor is not None
+
+def render_download(note, key):
+    # Deferred: the file is read from storage when the button is clicked, not on every rerun
+    st.download_button("Download", data=lambda: repo.read_blob(note.get("file_id")), file_name=note["file_name"], key=key, on_click="ignore")
+
+def load_trash(calendar, pages):
+    notes, cursor = [], None
+    for _ in range(pages):
+        page, cursor = cached_read(repo.trash_page, calendar, cursor)
+        notes += page
+        if cursor is None: break
+    return notes, cursor is not None
+
+def toggle_state(key, value):
+    st.session_state[key] = None if st.session_state.get(key) == value else value
+
+def render_trash_tab(calendar):
+    # Titles and dates come in pages; a note's content and images are fetched only when it is opened
+    tab = "c" if calendar else "d"
+    count = cached_read(repo.trash_count, calendar)
+    st.caption(f"{count} deleted notes")
+    if not count:
+        st.info("Empty")
+        return
+    if st.button(f"Empty {'Calendar' if calendar else 'Dashboard'} Trash"): repo.empty_trash(calendar=calendar); st.rerun()
+    pages_key, open_key = f"trash_pages_{tab}", f"trash_open_{tab}"
+    notes, has_more = load_trash(calendar, st.session_state.get(pages_key, 1))
+    for note in notes:
+        note_id = note['_id']
+        is_open = st.session_state.get(open_key) == note_id
+        date_label = f"{note.get('calendar_date') or 'Unknown'} - " if calendar else ""
+        deleted_label = f" · {note['deleted_at'].strftime('%d %b')}" if note.get('deleted_at') else ""
+        st.button(f"{'▾' if is_open else '▸'} 🗑 {date_label}{note.get('titolo') or 'Untitled'}{deleted_label}", key=f"o{tab}_{note_id}",
+                  on_click=toggle_state, args=(open_key, note_id), use_container_width=True)
+        if not is_open: continue
+        full = cached_read(repo.get_fields, note_id, "contenuto", "tipo", "file_id", "thumb_id")
+        if full.get("tipo") == "disegno" and full.get("file_id"):
+            render_note_image(full, f"t{tab}_{note_id}")
+        else:
+            st.markdown(f"<div class='quill-read-content'>{process_content_for_display(full.get('contenuto'))}</div>", unsafe_allow_html=True)
+        c1, c2 = st.columns(2)
+        if c1.button("↺ Restore", key=f"r{tab}_{note_id}"): repo.restore_from_trash(note_id); st.rerun()
+        if c2.button("✕ Delete", key=f"k{tab}_{note_id}"): repo.delete_note(note_id); st.rerun()
+    if has_more: st.button("Load more", key=f"trash_more_{tab}", on_click=st.session_state.update, args=({pages_key: st.session_state.get(pages_key, 1) + 1},))
 
 def render_badges(labels_list):
     if not labels_list: return ""
@@ -289,7 +419,7 @@ toolbar_config = [
     ['link'],
 ]
 
-def logic_save_note(title, labels_str, content, file, note_type, drawing_res, date_ref=None, is_recur=False, end_year=None):
+def logic_save_note(title, labels_str, content, file, note_type, drawing_res, date_ref=None, recur=None):
     has_content = False
     if title and title.strip(): has_content = True
     if content and content.strip(): has_content = True
@@ -298,58 +428,62 @@ def logic_save_note(title, labels_str, content, file, note_type, drawing_res, da
     
     if has_content:
         labels_list = [tag.strip() for tag in labels_str.split(",") if tag.strip()]
-        last_note = collection.find_one(sort=[("custom_order", -1)])
-        new_order = (last_note["custom_order"] + 1) if last_note and "custom_order" in last_note else 0
         
         doc = {
             "titolo": title,
             "labels": labels_list,
             "data": datetime.now(),
-            "custom_order": new_order,
             "tipo": "testo_ricco" if note_type == "Text" else "disegno",
             "deleted": False, "pinned": False,
             "calendar_date": date_ref
         }
         
-        if date_ref and is_recur:
-            doc["recurrence"] = "yearly"
-            dt_obj = datetime.strptime(date_ref, "%Y-%m-%d")
-            doc["cal_month"] = dt_obj.month
-            doc["cal_day"] = dt_obj.day
-            if end_year: doc["recur_end_year"] = end_year
+        if date_ref and recur:
+            doc.update(series_fields(date_ref, recur["freq"], recur.get("interval", 1), recur.get("weekdays"), recur.get("until"), recur.get("count")))
 
         if note_type == "Text":
             doc["contenuto"] = content
-            doc["file_name"] = file.name if file else None
-            doc["file_data"] = bson.binary.Binary(file.getvalue()) if file else None
-        else:
-            doc["contenuto"] = "Drawing"
-            img = Image.fromarray(drawing_res.image_data.astype('uint8'), 'RGBA')
-            buf = io.BytesIO()
-            img.save(buf, format='PNG')
-            val_bytes = buf.getvalue()
-            if len(val_bytes) > 0:
-                doc["file_data"] = bson.binary.Binary(val_bytes)
-                doc["file_name"] = "drawing.png"
-                doc["drawing_json"] = json.dumps(drawing_res.json_data)
-            else:
-                return False
-
-        collection.insert_one(doc)
-        return True
+            doc["file_name"] = None
+            doc["file_id"] = None
+            doc["file_size"] = 0
+            if not file:
+                repo.create_note(doc)
+                return True
+            # The upload is written in the background; the note shows as pending until then
+            return track_save(title or file.name, writequeue.submit(repo.create_note, doc, file, file.name))
+        doc["contenuto"] = "Drawing"
+        doc["drawing_json"] = json.dumps(drawing_res.json_data)
+        return track_save(title or "Drawing", save_drawing(drawing_res.image_data, lambda png: repo.create_note(doc, png, "drawing.png")))
     return False
 
+def render_recurrence_picker(key_suffix, date_ref):
+    # Returns the rule for logic_save_note, or None for a one-off note
+    choice = st.selectbox("Repeat", ["Never", "Daily", "Weekly", "Monthly", "Yearly", "Custom (RRULE)"], key=f"rec_{key_suffix}")
+    if choice == "Never": return None
+    if choice == "Custom (RRULE)":
+        text = st.text_input("RRULE", placeholder="FREQ=WEEKLY;BYDAY=MO,TH;COUNT=10", key=f"rr_{key_suffix}")
+        if not text: return None
+        try: return parse_rrule(text)
+        except ValueError as e:
+            st.error(f"Invalid rule: {e}")
+            return None
+    rule = {"freq": choice.lower()}
+    rule["interval"] = st.number_input("Every", min_value=1, max_value=365, value=1, key=f"ri_{key_suffix}")
+    if choice == "Weekly":
+        start_wd = datetime.strptime(date_ref, "%Y-%m-%d").weekday()
+        rule["weekdays"] = st.multiselect("On", list(range(7)), default=[start_wd], format_func=lambda d: calendar.day_abbr[d], key=f"rw_{key_suffix}") or None
+    until = st.date_input("Until (optional)", value=None, key=f"ru_{key_suffix}")
+    if until: rule["until"] = until.strftime("%Y-%m-%d")
+    return rule
+
 def render_create_note_form(key_suffix, date_ref=None):
-    recur_val = False
-    stop_year_val = None
+    recur_rule = None
     if date_ref:
         col_type, col_recur = st.columns([2, 2])
         with col_type:
             note_type = st.radio("Type:", ["Text", "Drawing"], horizontal=True, key=f"nt_{key_suffix}")
         with col_recur:
-            recur_val = st.checkbox("Repeat every year (Annual)", key=f"rec_{key_suffix}")
-            if recur_val:
-                stop_year_val = st.number_input("Stop after year", min_value=2025, max_value=2124, value=None, key=f"sy_{key_suffix}")
+            recur_rule = render_recurrence_picker(key_suffix, date_ref)
     else:
         note_type = st.radio("Type:", ["Text", "Drawing"], horizontal=True, key=f"nt_{key_suffix}")
 
@@ -368,8 +502,9 @@ def render_create_note_form(key_suffix, date_ref=None):
                 submitted = st.form_submit_button("Save Note")
             
             if submitted:
-                if logic_save_note(title, labels, content, f_up, "Text", None, date_ref, recur_val, stop_year_val):
-                    st.toast("Saved!", icon="✅")
+                saved = logic_save_note(title, labels, content, f_up, "Text", None, date_ref, recur_rule)
+                if saved:
+                    if saved is True: st.toast("Saved!", icon="✅")
                     if not date_ref:
                         st.session_state.create_key = str(uuid.uuid4())
                         st.session_state.reset_counter += 1
@@ -406,8 +541,7 @@ def render_create_note_form(key_suffix, date_ref=None):
         res = st_canvas(fill_color="rgba(0,0,0,0)", stroke_width=sw, stroke_color=fc, background_color="#FFF", update_streamlit=True, height=ch, width=cw, drawing_mode="freedraw", key=ckey)
         
         if st.button("Save Drawing", key=f"bs_{key_suffix}"):
-            if logic_save_note(title, labels, None, None, "Drawing", res, date_ref, recur_val, stop_year_val):
-                st.toast("Saved!", icon="✅")
+            if logic_save_note(title, labels, None, None, "Drawing", res, date_ref, recur_rule):
                 if not date_ref:
                     st.session_state.create_key = str(uuid.uuid4())
                     st.session_state.reset_counter += 1
@@ -419,6 +553,29 @@ def render_create_note_form(key_suffix, date_ref=None):
 
 # --- 8. POPUPS ---
 
+def backup_bytes(include_files):
+    # Called by the download request, not the script; Streamlit serves the archive from memory
+    archive, _ = repo.export_backup(include_files)
+    with archive: return archive.read()
+
+def render_perf_panel():
+    # Reruns recorded since the panel was switched on, newest first; the one opening this dialog is left out
+    runs = [r for r in st.session_state.perf_runs if r is not perf.current()]
+    if st.session_state.get("first_interactive_ms"): st.caption(f"First interactive this session: {st.session_state.first_interactive_ms} ms")
+    if not runs:
+        st.caption("Nothing recorded yet: use the app, then reopen Settings.")
+        return
+    summaries = [r.summary() for r in reversed(runs)]
+    st.dataframe([{"run": s["run"], "at": s["at"], "ms": s["total_ms"], "ops": s["ops"], "KB in": round(s["bytes_received"] / 1024, 1), "complete": s["complete"]} for s in summaries], hide_index=True)
+    pick = st.selectbox("Breakdown of run", [s["run"] for s in summaries])
+    chosen = next(s for s in summaries if s["run"] == pick)
+    st.caption("Timers (inclusive: nested timers are counted in their parent too)")
+    st.dataframe([{"timer": name, "ms": t["total"], "calls": t["calls"]} for name, t in sorted(chosen["timers_ms"].items(), key=lambda kv: -kv[1]["total"])], hide_index=True)
+    st.caption("Storage commands")
+    st.dataframe([{"command": name, "count": c["count"], "bytes out": c["sent"], "bytes in": c["received"]} for name, c in chosen["by_command"].items()], hide_index=True)
+    if st.button("Export to log file"):
+        st.caption(f"Appended {perf.export_runs(runs)} reruns to {perf.LOG_PATH}")
+
 @st.dialog("Settings")
 def open_settings():
     st.write("**Appearance**")
@@ -433,60 +590,58 @@ def open_settings():
     
     st.divider()
     st.write("**Statistics**")
-    all_notes_stat = list(collection.find({}))
-    total_count = len(all_notes_stat)
-    dash_count = len([n for n in all_notes_stat if not n.get('calendar_date') and not n.get('deleted')])
-    cal_count = len([n for n in all_notes_stat if n.get('calendar_date') and not n.get('deleted')])
-    trash_count = len([n for n in all_notes_stat if n.get('deleted')])
+    stats = get_storage_stats()
     
-    total_size_bytes = 0
-    for n in all_notes_stat:
-        total_size_bytes += len(str(n))
-        if n.get("file_data"): total_size_bytes += len(n["file_data"])
-    
-    size_mb = total_size_bytes / (1024 * 1024)
+    size_mb = stats["storage_bytes"] / (1024 * 1024)
     percentage = (size_mb / 512) * 100 
     
     c1, c2, c3 = st.columns(3)
-    c1.metric("Total Notes", total_count)
-    c2.metric("Dashboard", dash_count)
-    c3.metric("Calendar", cal_count)
-    st.metric("Trash", trash_count)
+    c1.metric("Total Notes", stats["total"])
+    c2.metric("Dashboard", stats["dashboard"])
+    c3.metric("Calendar", stats["calendar"])
+    st.metric("Trash", stats["trash"])
     st.write(f"**Storage Used:** {size_mb:.2f} MB / 512 MB")
     st.progress(min(percentage / 100, 1.0))
 
     st.divider()
     st.write("**Data**")
-    json_data = convert_notes_to_json(all_notes_stat)
-    st.download_button("Download Backup (.json)", data=json_data, file_name=f"backup_{datetime.now().strftime('%Y%m%d')}.json", mime="application/json")
+    # The backup is only built on click (deferred download), so opening Settings reads no notes.
+    # Streamlit serves a download from memory in one piece, so files are opt-in and the size is shown first
+    include_files = st.checkbox("Include attachments and drawings", value=False)
+    estimate = stats["storage_bytes"] if include_files else stats["notes_bytes"]
+    st.caption(f"Up to about {estimate / (1024 * 1024):.1f} MB before compression, held in memory while it downloads")
+    st.download_button("Download Backup (.tar.gz)", data=lambda: backup_bytes(include_files), file_name=f"backup_{datetime.now().strftime('%Y%m%d')}.tar.gz", mime="application/gzip", on_click="ignore")
     
-    uploaded_backup = st.file_uploader("Upload Backup (.json)", type=["json"])
+    uploaded_backup = st.file_uploader("Upload Backup (.tar.gz / .json)", type=["gz", "json", "ndjson"])
     if uploaded_backup is not None:
         if st.button("Confirm Restore (Adds to DB)"):
             try:
-                data = json.load(uploaded_backup)
-                if isinstance(data, list):
-                    for note in data:
-                        if '_id' in note: del note['_id']
-                        if 'data' in note and isinstance(note['data'], str):
-                            try: note['data'] = datetime.strptime(note['data'], "%Y-%m-%d %H:%M:%S")
-                            except: note['data'] = datetime.now()
-                    if data:
-                        collection.insert_many(data)
-                        st.success(f"Restored {len(data)} notes!")
-                        time.sleep(1)
-                        st.rerun()
+                bar = st.progress(0.0, text="Restoring...")
+                counts = repo.import_backup(
+                    uploaded_backup,
+                    progress=lambda frac, done, skipped: bar.progress(frac, text=f"Restored {done} notes, skipped {skipped} already present")
+                )
+                st.success(f"Restored {counts['restored']} notes! ({counts['skipped']} already present)")
+                time.sleep(1)
+                st.rerun()
             except Exception as e:
                 st.error(f"Error restoring: {e}")
 
     st.write("**Maintenance**")
-    is_auto = st.toggle("Auto-delete items older than 30 days", value=st.session_state.auto_clean_enabled)
-    if is_auto != st.session_state.auto_clean_enabled:
-        st.session_state.auto_clean_enabled = is_auto
-        if is_auto:
-            limit = datetime.now() - timedelta(days=30)
-            res = collection.delete_many({"deleted": True, "data": {"$lt": limit}})
-            st.toast(f"Auto-cleaned {res.deleted_count} items")
+    # Stored in the database: the background purger (trash.py) checks it for every session
+    auto_clean = get_trash_auto_clean()
+    is_auto = st.toggle(f"Auto-delete items {TRASH_RETENTION_DAYS} days after they are trashed", value=auto_clean)
+    if is_auto != auto_clean:
+        repo.set_trash_auto_clean(is_auto)
+        get_trash_auto_clean.clear()
+        if is_auto: st.toast(f"Auto-cleaned {purge_expired(repo)} items")
+
+    st.write("**Performance**")
+    is_perf = st.toggle("Record reruns (debug panel)", value=st.session_state.perf_enabled)
+    if is_perf != st.session_state.perf_enabled:
+        st.session_state.perf_enabled = is_perf
+        st.rerun()
+    if is_perf: render_perf_panel()
 
 @st.dialog("Edit Note", width="large")
 def open_edit_popup(note_id, old_title, old_content, old_filename, old_labels, note_type, drawing_data=None, date_ref=None, is_default=False):
@@ -533,32 +688,28 @@ def open_edit_popup(note_id, old_title, old_content, old_filename, old_labels, n
 
         if st.form_submit_button("Save Changes", type="primary"):
             labels_list = [tag.strip() for tag in new_labels_str.split(",") if tag.strip()]
-            update_data = {"titolo": new_title, "labels": labels_list, "data": datetime.now()}
+            update_data = {"titolo": new_title, "labels": labels_list, "contenuto": old_content, "data": datetime.now()}
+            file_bytes, file_name = None, None
             
-            if note_type == "disegno":
-                if canvas_result.image_data is not None:
-                    update_data["drawing_json"] = json.dumps(canvas_result.json_data)
-                    img = Image.fromarray(canvas_result.image_data.astype('uint8'), 'RGBA')
-                    buf = io.BytesIO()
-                    img.save(buf, format='PNG')
-                    val_bytes = buf.getvalue()
-                    if len(val_bytes) > 0:
-                        update_data["file_data"] = bson.binary.Binary(val_bytes)
-                        update_data["file_name"] = "drawing.png"
+            if note_type == "disegno" and canvas_result.image_data is not None:
+                update_data["drawing_json"] = json.dumps(canvas_result.json_data)
+                track_save(new_title or "Drawing", save_drawing(canvas_result.image_data, lambda png: repo.update_note(note_id, update_data, png, "drawing.png", date_ref=date_ref)))
             else:
-                update_data["contenuto"] = new_content
-                if new_file:
-                    update_data["file_name"] = new_file.name
-                    update_data["file_data"] = bson.binary.Binary(new_file.getvalue())
-            
-            collection.update_one({"_id": note_id}, {"$set": update_data})
+                if note_type != "disegno":
+                    update_data["contenuto"] = new_content
+                    if new_file:
+                        file_bytes, file_name = new_file, new_file.name
+                if file_bytes is not None:
+                    track_save(new_title or file_name, writequeue.submit(repo.update_note, note_id, update_data, file_bytes, file_name, date_ref=date_ref))
+                else:
+                    repo.update_note(note_id, update_data, file_bytes, file_name, date_ref=date_ref)
             st.session_state.edit_trigger += 1 
             st.rerun()
 
     if old_filename and note_type != "disegno":
         st.info(f"Current file: **{old_filename}**")
         if st.button("Remove file", key=f"rm_file_{note_id}"):
-            collection.update_one({"_id": note_id}, {"$set": {"file_name": None, "file_data": None}})
+            repo.remove_file(note_id)
             st.rerun()
 
 @st.dialog("Manage Dashboard Note", width="large")
@@ -568,40 +719,25 @@ def open_dash_move_popup(current_note_id):
     
     if action == "Swap Position":
         st.caption("Swap order with another dashboard note")
-        candidates = list(collection.find({"deleted": {"$ne": True}, "_id": {"$ne": current_note_id}, "calendar_date": None}).sort("custom_order", 1))
+        candidates = cached_read(repo.dashboard_candidates, current_note_id)
         if not candidates: st.warning("No notes available."); return
         options = {n["_id"]: f"{'📌' if n.get('pinned') else '📄'} {n['titolo']}" for n in candidates}
         selected_target_id = st.selectbox("Swap with:", options.keys(), format_func=lambda x: options[x])
         
         c_swap, c_insert = st.columns(2)
         if c_swap.button("Swap Positions ⇄", use_container_width=True):
-            n1 = collection.find_one({"_id": current_note_id})
-            n2 = collection.find_one({"_id": selected_target_id})
-            collection.update_one({"_id": current_note_id}, {"$set": {"custom_order": n2["custom_order"], "pinned": n2["pinned"]}})
-            collection.update_one({"_id": selected_target_id}, {"$set": {"custom_order": n1["custom_order"], "pinned": n1["pinned"]}})
+            repo.swap_positions(current_note_id, selected_target_id)
             st.rerun()
         
         # 4) THIN VERTICAL ARROW
         if c_insert.button("Insert Before ↑", use_container_width=True):
-            n2 = collection.find_one({"_id": selected_target_id})
-            t_order = n2["custom_order"]
-            collection.update_one({"_id": current_note_id}, {"$set": {"custom_order": t_order, "pinned": n2["pinned"]}})
-            collection.update_many({"custom_order": {"$gte": t_order}, "_id": {"$ne": current_note_id}, "calendar_date": None}, {"$inc": {"custom_order": 1}})
+            repo.insert_before(current_note_id, selected_target_id)
             st.rerun()
 
     elif action == "Duplicate Note":
         st.caption("Create a copy of this note in the dashboard")
         if st.button("Confirm Duplication ❐"):
-            note = collection.find_one({"_id": current_note_id})
-            new_doc = note.copy()
-            del new_doc['_id']
-            new_doc['titolo'] = f"{new_doc['titolo']} (Copy)"
-            new_doc['data'] = datetime.now()
-            # Append to end
-            last_note = collection.find_one(sort=[("custom_order", -1)])
-            new_order = (last_note["custom_order"] + 1) if last_note and "custom_order" in last_note else 0
-            new_doc['custom_order'] = new_order
-            collection.insert_one(new_doc)
+            repo.duplicate_note(current_note_id)
             st.success("Note Duplicated!")
             time.sleep(0.5)
             st.rerun()
@@ -620,20 +756,11 @@ def open_cal_move_popup(note_id, current_date_str):
     mode = st.radio("Mode", ["Move (Change Date)", "Copy (Keep Original)"], index=0)
     
     if st.button("Confirm Action", type="primary"):
-        note = collection.find_one({"_id": note_id})
-        
         if mode == "Move (Change Date)":
-            collection.update_one({"_id": note_id}, {"$set": {"calendar_date": target_date_str}})
+            repo.move_to_date(note_id, current_date_str, target_date_str)
             st.toast("Note Moved!")
         else:
-            new_doc = note.copy()
-            del new_doc['_id']
-            new_doc['calendar_date'] = target_date_str
-            new_doc['data'] = datetime.now()
-            if new_doc.get('is_default'):
-                new_doc['is_default'] = False # Copy is not default
-                new_doc['titolo'] = f"Copy of {new_doc['titolo']}"
-            collection.insert_one(new_doc)
+            repo.copy_to_date(note_id, current_date_str, target_date_str)
             st.toast("Note Copied!")
             
         time.sleep(0.5)
@@ -642,45 +769,14 @@ def open_cal_move_popup(note_id, current_date_str):
 @st.dialog("Trash", width="large")
 def open_trash():
     t_dash, t_cal = st.tabs(["Dashboard", "Calendar"])
-    with t_dash:
-        trash_notes = list(collection.find({"deleted": True, "calendar_date": None}).sort("data", -1))
-        st.caption(f"{len(trash_notes)} deleted notes")
-        if not trash_notes: st.info("Empty")
-        else:
-            if st.button("Empty Dashboard Trash"): collection.delete_many({"deleted": True, "calendar_date": None}); st.rerun()
-            for note in trash_notes:
-                with st.expander(f"🗑 {note.get('titolo') or 'Untitled'}"):
-                    if note.get("tipo") == "disegno" and note.get("file_data"):
-                        try: st.image(Image.open(io.BytesIO(note["file_data"])))
-                        except: pass
-                    else:
-                        st.markdown(f"<div class='quill-read-content'>{process_content_for_display(note['contenuto'])}</div>", unsafe_allow_html=True)
-                    c1, c2 = st.columns(2)
-                    if c1.button("↺ Restore", key=f"rd_{note['_id']}"): collection.update_one({"_id": note['_id']}, {"$set": {"deleted": False}}); st.rerun()
-                    if c2.button("✕ Delete", key=f"kd_{note['_id']}"): collection.delete_one({"_id": note['_id']}); st.rerun()
-    with t_cal:
-        trash_cal = list(collection.find({"deleted": True, "calendar_date": {"$ne": None}}).sort("data", -1))
-        st.caption(f"{len(trash_cal)} deleted notes")
-        if not trash_cal: st.info("Empty")
-        else:
-            if st.button("Empty Calendar Trash"): collection.delete_many({"deleted": True, "calendar_date": {"$ne": None}}); st.rerun()
-            for note in trash_cal:
-                date_label = note['calendar_date'] if note.get('calendar_date') else "Unknown"
-                with st.expander(f"🗑 {date_label} - {note.get('titolo') or 'Untitled'}"):
-                    if note.get("tipo") == "disegno" and note.get("file_data"):
-                        try: st.image(Image.open(io.BytesIO(note["file_data"])))
-                        except: pass
-                    else:
-                        st.markdown(f"<div class='quill-read-content'>{process_content_for_display(note['contenuto'])}</div>", unsafe_allow_html=True)
-                    c1, c2 = st.columns(2)
-                    if c1.button("↺ Restore", key=f"rc_{note['_id']}"): collection.update_one({"_id": note['_id']}, {"$set": {"deleted": False}}); st.rerun()
-                    if c2.button("✕ Delete", key=f"kc_{note['_id']}"): collection.delete_one({"_id": note['_id']}); st.rerun()
+    with t_dash: render_trash_tab(calendar=False)
+    with t_cal: render_trash_tab(calendar=True)
 
 @st.dialog("Confirmation")
 def confirm_deletion(note_id):
     st.write("Move to trash?")
     c1, c2 = st.columns(2)
-    if c1.button("Yes", type="primary"): collection.update_one({"_id": note_id}, {"$set": {"deleted": True}}); st.rerun()
+    if c1.button("Yes", type="primary"): repo.move_to_trash(note_id); st.rerun()
     if c2.button("Cancel"): st.rerun()
 
 # --- MAIN LAYOUT ---
@@ -695,6 +791,7 @@ with head_col3:
     if st.button("🗑", help="Trash"): open_trash()
 
 st.markdown("---") 
+if st.session_state.pending_saves: watch_pending_saves()
 
 # --- TABS ---
 tab_dash, tab_cal = st.tabs(["DASHBOARD", "CALENDAR"])
@@ -703,27 +800,24 @@ tab_dash, tab_cal = st.tabs(["DASHBOARD", "CALENDAR"])
 with tab_dash:
     expander_label = f"+ Create New Note{'\u200b' * st.session_state.reset_counter}"
     with st.expander(expander_label, expanded=False):
-        render_create_note_form("dash_create") 
+        # The form (and the editor behind it) is built once asked for; a save bumps reset_counter and closes it again
+        if st.session_state.get("compose_open") == st.session_state.reset_counter:
+            render_create_note_form("dash_create")
+        else:
+            st.button("✎ Write a note", key="dash_compose", on_click=toggle_state, args=("compose_open", st.session_state.reset_counter))
 
     st.write("")
     query = st.text_input("🔍", placeholder="Search in the Dashboard...", label_visibility="collapsed", key="dash_search")
 
-    filter_query = {"deleted": {"$ne": True}, "calendar_date": None}
-    if query:
-        filter_query["$and"] = [
-            {"deleted": {"$ne": True}},
-            {"calendar_date": None},
-            {"$or": [
-                {"titolo": {"$regex": query, "$options": "i"}},
-                {"contenuto": {"$regex": query, "$options": "i"}},
-                {"labels": {"$regex": query, "$options": "i"}}
-            ]}
-        ]
-
-    all_notes = list(collection.find(filter_query).sort("custom_order", 1)) 
+    # A new search starts again from the first page
+    if st.session_state.get('dash_pages_query') != query:
+        st.session_state.dash_pages_query = query
+        st.session_state.dash_pages = 1
+    all_notes, has_more = load_dashboard(query, st.session_state.dash_pages)
     pinned_notes = [n for n in all_notes if n.get("pinned", False)]
     other_notes = [n for n in all_notes if not n.get("pinned", False)]
 
+    @perf.timed("render_dash_grid")
     def render_dash_grid(note_list):
         if not note_list: return
         num_cols = st.session_state.grid_cols
@@ -740,16 +834,16 @@ with tab_dash:
                 
                 with st.expander(full_title):
                     if labels: st.markdown(render_badges(labels), unsafe_allow_html=True)
-                    if note.get("tipo") == "disegno" and note.get("file_data") and len(note["file_data"]) > 0:
-                        try: st.image(Image.open(io.BytesIO(note["file_data"])))
-                        except: pass
+                    if note.get("tipo") == "disegno" and note.get("file_id"):
+                        render_note_image(note, f"di_{note['_id']}")
                     else:
                         st.markdown(f"<div class='quill-read-content'>{process_content_for_display(note['contenuto'])}</div>", unsafe_allow_html=True)
                     
                     if note.get("file_name") and note.get("tipo") != "disegno":
                         st.markdown("---")
                         st.caption(f"File: {note['file_name']}")
-                        st.download_button("Download", data=note["file_data"], file_name=note["file_name"], key=f"dl_{note['_id']}")
+                        if note.get("thumb_id"): render_note_image(note, f"da_{note['_id']}")
+                        render_download(note, f"dl_{note['_id']}")
                     
                     # --- NEW ACTION MENU (POPOVER) ---
                     # Placed in a column with ratio [5, 1] to push it to the right
@@ -757,12 +851,12 @@ with tab_dash:
                     with c_menu:
                         with st.popover("⋮", use_container_width=True):
                             if st.button("Edit ✎", key=f"m_{note['_id']}", use_container_width=True):
-                                draw_data = note.get("drawing_json", None)
+                                draw_data = repo.get_fields(note['_id'], "drawing_json").get("drawing_json") if note.get("tipo") == "disegno" else None
                                 open_edit_popup(note['_id'], note['titolo'], note['contenuto'], note.get("file_name"), labels, note.get("tipo"), draw_data)
                             
                             pin_label = "Unpin 📌" if note.get("pinned") else "Pin 📌"
                             if st.button(pin_label, key=f"p_{note['_id']}", use_container_width=True):
-                                 collection.update_one({"_id": note['_id']}, {"$set": {"pinned": not note.get("pinned", False)}})
+                                 repo.set_pinned(note['_id'], not note.get("pinned", False))
                                  st.rerun()
                             
                             # 2) RENAME BUTTON TO "Move ⇄"
@@ -780,6 +874,9 @@ with tab_dash:
             st.write("") 
             st.markdown("<div class='section-header'>All Notes</div>", unsafe_allow_html=True) 
         render_dash_grid(other_notes)
+        if has_more and st.button("Load more", key="dash_more"):
+            st.session_state.dash_pages += 1
+            st.rerun()
 
 # ================= CALENDAR TAB =================
 with tab_cal:
@@ -825,78 +922,25 @@ with tab_cal:
     st.markdown("<hr style='margin: 15px 0; border-top: 2px solid #888; opacity: 1;'>", unsafe_allow_html=True)
 
     num_days = calendar.monthrange(st.session_state.cal_year, st.session_state.cal_month)[1]
-    
-    start_date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-01"
-    end_date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{num_days}"
-    
-    q_reg = {"calendar_date": {"$gte": start_date_str, "$lte": end_date_str}, "deleted": {"$ne": True}}
-    q_rec = {"deleted": {"$ne": True}, "recurrence": "yearly", "cal_month": st.session_state.cal_month, "$or": [{"recur_end_year": None}, {"recur_end_year": {"$gt": st.session_state.cal_year}}]}
-    
-    if cal_query:
-        search_filter = {"$or": [
-            {"titolo": {"$regex": cal_query, "$options": "i"}},
-            {"contenuto": {"$regex": cal_query, "$options": "i"}},
-            {"labels": {"$regex": cal_query, "$options": "i"}}
-        ]}
-        q_reg.update(search_filter)
-        q_rec.update(search_filter)
-
-    month_notes_reg = list(collection.find(q_reg))
-    month_notes_rec = list(collection.find(q_rec))
-    
-    valid_recurring = []
-    reg_ids = {str(n["_id"]) for n in month_notes_reg}
-    for n in month_notes_rec:
-        orig_date = datetime.strptime(n["calendar_date"], "%Y-%m-%d")
-        if st.session_state.cal_year > orig_date.year: valid_recurring.append(n)
-        elif str(n["_id"]) not in reg_ids: valid_recurring.append(n)
-
-    all_cal_notes = month_notes_reg + valid_recurring
-    
-    notes_by_day = {}
-    for n in all_cal_notes:
-        if n.get("recurrence") == "yearly" and st.session_state.cal_year > datetime.strptime(n["calendar_date"], "%Y-%m-%d").year:
-             d = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{n['cal_day']:02d}"
-        else:
-             d = n["calendar_date"]
-        if d not in notes_by_day: notes_by_day[d] = []
-        notes_by_day[d].append(n)
-    
-    for day in range(1, num_days + 1):
-        date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{day:02d}"
-        dt = date(st.session_state.cal_year, st.session_state.cal_month, day)
-        day_name = dt.strftime("%A, %d %B %Y")
-        
-        has_default = False
-        if date_str in notes_by_day:
-            for n in notes_by_day[date_str]:
-                if n.get('titolo') == "Compiti del giorno" and n.get('is_default'):
-                    has_default = True
-                    break
-        
-        if not has_default and not cal_query: 
-            def_doc = {
-                "titolo": "Compiti del giorno",
-                "contenuto": "",
-                "labels": [],
-                "data": datetime.now(),
-                "custom_order": -1,
-                "tipo": "testo_ricco",
-                "deleted": False, "pinned": False,
-                "calendar_date": date_str,
-                "is_default": True
-            }
-            collection.insert_one(def_doc)
-            if date_str not in notes_by_day: notes_by_day[date_str] = []
-            notes_by_day[date_str].insert(0, def_doc)
-
-        notes_today = notes_by_day.get(date_str, [])
-        if cal_query and not notes_today: continue
-
-        st.markdown(f"<div class='section-header'>{day_name}</div>", unsafe_allow_html=True) 
-        
+    compact = st.toggle("Month grid", key="cal_compact")
+
+    def group_by_day(month_notes_reg, occurrences):
+        # One-off notes sit on their calendar_date; recurring ones come already expanded per date
+        notes_by_day = {}
+        for n in month_notes_reg:
+            notes_by_day.setdefault(n["calendar_date"], []).append(n)
+        for d, n in occurrences:
+            notes_by_day.setdefault(d, []).append(n)
+        return notes_by_day
+
+    def day_notes(notes_by_day, date_str):
+        notes_today = list(notes_by_day.get(date_str, []))
+        has_default = any(n.get('titolo') == "Compiti del giorno" and n.get('is_default') for n in notes_today)
+        if not has_default and not cal_query: notes_today.insert(0, virtual_day_note(date_str))
         notes_today.sort(key=lambda x: x.get('custom_order', 0))
-        
+        return notes_today
+
+    def render_cal_day(day, date_str, notes_today):
         if notes_today:
             for note in notes_today:
                 with st.container():
@@ -917,28 +961,33 @@ with tab_cal:
                          # UNIFIED MENU FOR ALL CALENDAR NOTES
                         with st.popover("⋮", use_container_width=True):
                             
-                            if st.button("Edit ✎", key=f"ced_{note['_id']}", use_container_width=True):
-                                draw_data = note.get("drawing_json", None)
+                            if st.button("Edit ✎", key=f"ced_{note['_id']}_{date_str}", use_container_width=True):
+                                draw_data = repo.get_fields(note['_id'], "drawing_json").get("drawing_json") if note.get("tipo") == "disegno" else None
                                 open_edit_popup(note['_id'], note['titolo'], note['contenuto'], note.get("file_name"), note.get("labels", []), note.get("tipo"), draw_data, date_ref=date_str, is_default=note.get('is_default', False))
                             
                             # 2) RENAME BUTTON TO "Move ⇄"
-                            if st.button("Move ⇄", key=f"ccp_{note['_id']}", use_container_width=True):
+                            if st.button("Move ⇄", key=f"ccp_{note['_id']}_{date_str}", use_container_width=True):
                                 open_cal_move_popup(note['_id'], date_str)
 
-                            if st.button("Delete 🗑", key=f"cdel_{note['_id']}", use_container_width=True):
+                            if note.get("recurrence") and st.button("Skip this date", key=f"cskip_{note['_id']}_{date_str}", use_container_width=True):
+                                repo.skip_occurrence(note['_id'], date_str)
+                                st.rerun()
+
+                            # A virtual day note has nothing stored to delete
+                            if not note.get('is_virtual') and st.button("Delete 🗑", key=f"cdel_{note['_id']}_{date_str}", use_container_width=True):
                                 confirm_deletion(note['_id'])
 
                     if note.get("labels"): st.markdown(render_badges(note["labels"]), unsafe_allow_html=True)
-                    if note.get("recurrence") == "yearly": st.caption("🔄 Annual")
+                    if note.get("recurrence"): st.caption(f"🔄 {describe(note)}")
 
-                    if note.get("tipo") == "disegno" and note.get("file_data") and len(note["file_data"]) > 0:
-                        try: st.image(Image.open(io.BytesIO(note["file_data"])))
-                        except: pass
+                    if note.get("tipo") == "disegno" and note.get("file_id"):
+                        render_note_image(note, f"ci_{note['_id']}_{date_str}")
                     else:
                         st.markdown(f"<div class='quill-read-content'>{process_content_for_display(note['contenuto'])}</div>", unsafe_allow_html=True)
                     
                     if note.get("file_name") and note.get("tipo") != "disegno":
-                        st.download_button("Download", data=note["file_data"], file_name=note["file_name"], key=f"dlc_{note['_id']}")
+                        if note.get("thumb_id"): render_note_image(note, f"ca_{note['_id']}_{date_str}")
+                        render_download(note, f"dlc_{note['_id']}_{date_str}")
 
                     st.markdown("</div>", unsafe_allow_html=True)
         
@@ -957,3 +1006,43 @@ with tab_cal:
                     st.rerun()
         
         st.markdown("<hr style='margin: 15px 0; border-top: 2px solid #888; opacity: 1;'>", unsafe_allow_html=True)
+
+    if not compact:
+        notes_by_day = group_by_day(*cached_read(repo.month_notes, st.session_state.cal_year, st.session_state.cal_month, num_days, cal_query))
+        with perf.timer("calendar days"):
+            for day in range(1, num_days + 1):
+                date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{day:02d}"
+                notes_today = day_notes(notes_by_day, date_str)
+                if cal_query and not notes_today: continue
+                st.markdown(f"<div class='section-header'>{date(st.session_state.cal_year, st.session_state.cal_month, day).strftime('%A, %d %B %Y')}</div>", unsafe_allow_html=True) 
+                render_cal_day(day, date_str, notes_today)
+    else:
+        # Grid cells come from a titles-only query; content is fetched and rendered for the open day only
+        grid_by_day = group_by_day(*cached_read(repo.month_notes, st.session_state.cal_year, st.session_state.cal_month, num_days, cal_query, compact=True))
+        open_day = st.session_state.get("cal_open_day")
+        with perf.timer("calendar days"):
+            for week in calendar.monthcalendar(st.session_state.cal_year, st.session_state.cal_month):
+                cells = st.columns(7)
+                for cell, day in zip(cells, week):
+                    if not day: continue
+                    date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{day:02d}"
+                    stored = [n for n in grid_by_day.get(date_str, []) if not (n.get('is_default') and n.get('titolo') == "Compiti del giorno")]
+                    with cell:
+                        label = f"{day} · {len(stored)}" if stored else str(day)
+                        if st.button(label, key=f"gd_{date_str}", type="primary" if date_str == open_day else "secondary", use_container_width=True, disabled=bool(cal_query) and not stored):
+                            st.session_state.cal_open_day = None if date_str == open_day else date_str
+                            st.rerun()
+                        for n in stored[:3]: st.caption(n.get('titolo') or "Untitled")
+                        if len(stored) > 3: st.caption(f"+{len(stored) - 3} more")
+
+        if open_day and open_day.startswith(f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-"):
+            day = int(open_day[-2:])
+            notes_by_day = group_by_day(*cached_read(repo.month_notes, st.session_state.cal_year, st.session_state.cal_month, day, cal_query, first_day=day))
+            st.markdown(f"<div class='section-header'>{date(st.session_state.cal_year, st.session_state.cal_month, day).strftime('%A, %d %B %Y')}</div>", unsafe_allow_html=True)
+            render_cal_day(day, open_day, day_notes(notes_by_day, open_day))
+
+# Time to first interactive: script start to the end of a session's first complete run
+if 'first_load' not in st.session_state:
+    st.session_state.first_load = True
+    st.session_state.first_interactive_ms = round((time.perf_counter() - SCRIPT_STARTED) * 1000, 1)
+perf.finish_run()
@@ -0,0 +1,282 @@
+import codecs
+import hashlib
+import io
+import json
+import tarfile
+import tempfile
+import time
+from datetime import datetime
+from pymongo import UpdateOne
+from recurrence import legacy_series_fields
+
+# Backup archive layout (tar.gz):
+#   manifest.json           format version and options
+#   blobs/<sha256>          attachments, drawings and thumbnails, once per blob (optional)
+#   notes/000001.ndjson     notes, one JSON document per line, in batches
+# Blobs come first so a restore can store them before the notes that point at them.
+# Every member is written from a bounded buffer: one batch of notes or one blob chunk.
+FORMAT_VERSION = 1
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+BATCH_SIZE = 500
+DERIVED_FIELDS = {"search_text": 0, "search_terms": 0, "fingerprint": 0}
+DATE_FIELDS = ("data", "deleted_at")
+# What makes two notes "the same note" for restore dedupe. Ordering, pinning and
+# trash state are deliberately left out: they are not identity.
+FINGERPRINT_FIELDS = ("titolo", "contenuto", "labels", "tipo", "calendar_date", "file_id", "data")
+
+
+def _json_default(value):
+    if isinstance(value, datetime): return value.strftime(DATE_FORMAT)
+    # ObjectId and anything else BSON-specific
+    return str(value)
+
+
+class _ChunkReader(io.RawIOBase):
+    # File-like view over a chunk iterator, so tarfile can copy a blob without joining it
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            piece = next(self._chunks, None)
+            if piece is None: break
+            self._buf += piece
+        if size < 0: size = len(self._buf)
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def _add_member(tar, name, data_or_reader, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    fileobj = io.BytesIO(data_or_reader) if isinstance(data_or_reader, bytes) else data_or_reader
+    tar.addfile(info, fileobj)
+
+
+# Storage-independent writer: notes is an iterable of note dicts, blobs an
+# iterable of (blob_id, length, chunk iterator). Returns the counts written.
+def write_archive(fileobj, notes, blobs, include_files=True, batch_size=BATCH_SIZE):
+    counts = {"notes": 0, "blobs": 0}
+
+    with tarfile.open(fileobj=fileobj, mode="w:gz") as tar:
+        manifest = json.dumps({"format": FORMAT_VERSION, "created": datetime.now().strftime(DATE_FORMAT), "include_files": include_files}).encode()
+        _add_member(tar, "manifest.json", manifest, len(manifest))
+
+        for blob_id, length, chunks in blobs:
+            _add_member(tar, f"blobs/{blob_id}", _ChunkReader(chunks), length)
+            counts["blobs"] += 1
+
+        batch, part = [], 0
+        for note in notes:
+            batch.append(json.dumps(note, default=_json_default, ensure_ascii=False))
+            if len(batch) >= batch_size:
+                part += 1
+                _add_notes_member(tar, part, batch)
+                counts["notes"] += len(batch)
+                batch = []
+        if batch:
+            _add_notes_member(tar, part + 1, batch)
+            counts["notes"] += len(batch)
+    return counts
+
+
+def write_backup(collection, store, fileobj, include_files=True, batch_size=BATCH_SIZE):
+    projection = dict(DERIVED_FIELDS)
+    if not include_files: projection["drawing_json"] = 0
+
+    def blobs():
+        for blob_id in set(collection.distinct("file_id")) | set(collection.distinct("thumb_id")):
+            meta = store.files.find_one({"_id": blob_id}, {"length": 1}) if blob_id else None
+            if meta: yield blob_id, meta["length"], store.iter_chunks(blob_id)
+
+    notes = collection.find({}, projection).batch_size(batch_size)
+    return write_archive(fileobj, notes, blobs() if include_files else (), include_files, batch_size)
+
+
+def _add_notes_member(tar, part, lines):
+    data = ("\n".join(lines) + "\n").encode()
+    _add_member(tar, f"notes/{part:06d}.ndjson", data, len(data))
+
+
+def spool_backup(write):
+    # Compressed output spills to disk past 8 MB while it is written; write(fileobj) fills it and
+    # returns the counts. Returns the file rewound, ready to read. Memory is bounded only while
+    # building: whoever serves the archive (st.download_button) still reads it whole
+    out = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    counts = write(out)
+    out.seek(0)
+    return out, counts
+
+
+def build_backup(collection, store, include_files=True):
+    return spool_backup(lambda out: write_backup(collection, store, out, include_files))
+
+
+# --- RESTORE ---
+
+def note_fingerprint(note):
+    ident = {f: note.get(f) for f in FINGERPRINT_FIELDS}
+    return hashlib.sha256(json.dumps(ident, default=_json_default, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+# Notes touched since their fingerprint was taken have it unset; refill those first
+def backfill_fingerprints(collection, batch_size=BATCH_SIZE):
+    ops = []
+    projection = {f: 1 for f in FINGERPRINT_FIELDS}
+    for note in collection.find({"fingerprint": {"$exists": False}}, projection).batch_size(batch_size):
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"fingerprint": note_fingerprint(note)}}))
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
+
+
+def _iter_json_array(fileobj, chunk_size=64 * 1024):
+    # Legacy .json backups: one big array, decoded element by element
+    decoder = json.JSONDecoder()
+    reader = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, started = "", 0, False
+    while True:
+        raw = fileobj.read(chunk_size)
+        buf = buf[pos:] + reader.decode(raw or b"", final=not raw)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if not started and pos < len(buf):
+                if buf[pos] != "[": raise ValueError("Backup is not a JSON list")
+                started, pos = True, pos + 1
+                continue
+            if pos < len(buf) and buf[pos] == "]": return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            yield item
+            pos = end
+        if not raw:
+            if buf[pos:].strip(): raise ValueError("Backup ends in the middle of a note")
+            return
+
+
+def _iter_ndjson(stream):
+    for line in stream:
+        if line.strip(): yield json.loads(line)
+
+
+def iter_backup(fileobj, store=None):
+    # Yields notes from any backup format. Archive blobs are stored on the way,
+    # before the notes that reference them are reached.
+    head = fileobj.read(2)
+    fileobj.seek(0)
+    if head == b"\x1f\x8b":
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+            for member in tar:
+                if not member.isfile(): continue
+                if member.name.startswith("blobs/"):
+                    if store is not None: store.put_stream(member.name.split("/", 1)[1], tar.extractfile(member))
+                elif member.name.startswith("notes/"):
+                    yield from _iter_ndjson(tar.extractfile(member))
+    elif head.lstrip()[:1] == b"[":
+        yield from _iter_json_array(fileobj)
+    else:
+        yield from _iter_ndjson(fileobj)
+
+
+def prepare_note(note):
+    note.pop("_id", None)
+    for field in DERIVED_FIELDS: note.pop(field, None)
+    for field in DATE_FIELDS:
+        if isinstance(note.get(field), str):
+            try: note[field] = datetime.strptime(note[field], DATE_FORMAT)
+            except ValueError: note[field] = datetime.now()
+    note.setdefault("data", datetime.now())
+    note["pinned"] = bool(note.get("pinned"))
+    # Backups from before recurrence rules: the series migration has already run on this database
+    note.update(legacy_series_fields(note) or {})
+    # Older backups have trashed notes without deleted_at: their retention starts now
+    if note.get("deleted") and not isinstance(note.get("deleted_at"), datetime): note["deleted_at"] = datetime.now()
+    note["fingerprint"] = note_fingerprint(note)
+    return note
+
+
+def restore_notes(fileobj, store, known, stored, insert, prepare=None, progress=None, batch_size=BATCH_SIZE):
+    # The restore flow shared by both backends, batch by batch: known(fingerprints) and stored(blob_ids)
+    # return the subsets already in the database, insert(notes) writes the new notes as they are
+    # (fingerprint included). progress(fraction, restored, skipped)
+    fileobj.seek(0, io.SEEK_END)
+    total_bytes = fileobj.tell() or 1
+    fileobj.seek(0)
+    counts = {"restored": 0, "skipped": 0}
+
+    def flush(batch):
+        if not batch: return
+        in_db = known([n["fingerprint"] for n in batch])
+        blob_ids = [n[f] for n in batch for f in ("file_id", "thumb_id") if n.get(f)]
+        have = stored(blob_ids) if blob_ids else set()
+        fresh, seen = [], set()
+        for note in batch:
+            if note["fingerprint"] in in_db or note["fingerprint"] in seen:
+                counts["skipped"] += 1
+                continue
+            seen.add(note["fingerprint"])
+            # Backups made without files still reference blobs this database may not have
+            if note.get("file_id") and note["file_id"] not in have: note["file_id"] = None
+            if note.get("thumb_id") and (note["thumb_id"] not in have or not note.get("file_id")): note["thumb_id"] = None
+            fresh.append(note)
+        if fresh: insert(fresh)
+        counts["restored"] += len(fresh)
+        if progress: progress(min(fileobj.tell() / total_bytes, 1.0), counts["restored"], counts["skipped"])
+
+    batch = []
+    for note in iter_backup(fileobj, store):
+        note = prepare_note(note)
+        if prepare: prepare(note)
+        batch.append(note)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    flush(batch)
+    return counts
+
+
+def restore_backup(collection, store, fileobj, prepare=None, progress=None, batch_size=BATCH_SIZE):
+    # prepare: extra per-note hook (e.g. search fields); progress(fraction, restored, skipped)
+    backfill_fingerprints(collection)
+    restore_tag = f"restore-{time.time_ns()}"
+
+    def known(prints):
+        return {d["fingerprint"] for d in collection.find({"fingerprint": {"$in": prints}}, {"fingerprint": 1})}
+
+    def stored(blob_ids):
+        return {d["_id"] for d in store.files.find({"_id": {"$in": blob_ids}}, {"_id": 1})}
+
+    def insert(notes):
+        for note in notes:
+            if note.get("calendar_date") is None: note["restore_tag"] = restore_tag
+        collection.insert_many(notes, ordered=False)
+
+    counts = restore_notes(fileobj, store, known, stored, insert, prepare, progress, batch_size)
+    _rebuild_order(collection, restore_tag)
+    return counts
+
+
+def _rebuild_order(collection, restore_tag):
+    # Restored dashboard notes go after the existing ones, keeping their backup order,
+    # renumbered in a single pass so no custom_order collides
+    last = collection.find_one({"restore_tag": {"$exists": False}}, {"custom_order": 1}, sort=[("custom_order", -1)])
+    next_order = (last["custom_order"] + 1) if last and "custom_order" in last else 0
+    ops = []
+    cursor = collection.find({"restore_tag": restore_tag}, {"_id": 1}).sort([("custom_order", 1), ("data", 1)])
+    for note in cursor:
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"custom_order": next_order}, "$unset": {"restore_tag": ""}}))
+        next_order += 1
+        if len(ops) >= BATCH_SIZE:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
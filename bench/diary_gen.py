@@ -0,0 +1,143 @@
+import argparse
+import io
+import json
+import random
+import sys
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from PIL import Image, ImageDraw
+from drawings import encode_drawing
+from recurrence import series_fields
+from storage import open_repository
+
+# Seeded synthetic diaries for the benchmarks. The same seed and sizes always give
+# the same notes (titles, text, dates, drawings, files), so runs are comparable.
+# Notes are written through the repository, so either backend can be seeded.
+WORDS = (
+    "oggi domani lavoro casa spesa riunione progetto idea libro film viaggio treno mare "
+    "montagna cena pranzo amici famiglia scuola esame corsa palestra medico banca bolletta "
+    "regalo compleanno vacanza lista appunti pensiero ricetta musica concerto giardino "
+    "meeting deadline report draft review budget release backup server notes quick ideas"
+).split()
+LABELS = ("lavoro", "casa", "idee", "salute", "viaggi", "spesa", "letture", "urgente")
+CANVAS_SIZE = (600, 450)
+DEFAULTS = {
+    "dashboard": 300, "calendar": 1500, "years": 3, "recurring": 60,
+    "drawings": 40, "attachments": 30, "attachment_size": 256 * 1024, "trashed": 50,
+}
+
+
+def _sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+def _html(rng, paragraphs):
+    parts = []
+    for _ in range(paragraphs):
+        text = _sentence(rng, rng.randint(8, 40))
+        if rng.random() < 0.3:
+            word = rng.choice(WORDS)
+            text = text.replace(word, f"<strong>{word}</strong>", 1)
+        parts.append(f"<p>{text}</p>")
+    if rng.random() < 0.2:
+        parts.append("<ul>" + "".join(f"<li>{_sentence(rng, 4)}</li>" for _ in range(rng.randint(2, 6))) + "</ul>")
+    return "".join(parts)
+
+
+def _base(rng, when, calendar_date=None):
+    return {
+        "titolo": _sentence(rng, rng.randint(1, 4))[:-1], "labels": rng.sample(LABELS, rng.randint(0, 2)),
+        "data": when, "tipo": "testo_ricco", "deleted": False, "pinned": False,
+        "calendar_date": calendar_date, "contenuto": _html(rng, rng.randint(1, 5)),
+        "file_name": None, "file_id": None, "file_size": 0,
+    }
+
+
+def _drawing(rng):
+    # Free-hand strokes as st_canvas returns them: fabric.js JSON plus the RGBA pixels
+    img = Image.new("RGBA", CANVAS_SIZE, (255, 255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    objects = []
+    for _ in range(rng.randint(3, 25)):
+        x, y = rng.randint(0, CANVAS_SIZE[0]), rng.randint(0, CANVAS_SIZE[1])
+        points, path = [(x, y)], [["M", x, y]]
+        for _ in range(rng.randint(10, 80)):
+            x = min(max(x + rng.randint(-12, 12), 0), CANVAS_SIZE[0] - 1)
+            y = min(max(y + rng.randint(-12, 12), 0), CANVAS_SIZE[1] - 1)
+            points.append((x, y))
+            path.append(["Q", x, y, x, y])
+        color, width = rng.choice(("#000000", "#d62728", "#1f77b4")), rng.randint(1, 6)
+        draw.line(points, fill=color, width=width)
+        objects.append({"type": "path", "stroke": color, "strokeWidth": width, "fill": None, "path": path})
+    fabric = {"version": "4.4.0", "objects": objects, "background": "#FFFFFF"}
+    return json.dumps(fabric), encode_drawing(np.asarray(img))
+
+
+def _attachment(rng, size, index):
+    # Half photos (noise JPEG of roughly 'size' bytes, so thumbnails get made), half opaque files
+    if index % 2:
+        return rng.randbytes(size), f"file_{index}.pdf"
+    side = max(int((size / 1.5) ** 0.5), 16)
+    pixels = np.frombuffer(rng.randbytes(side * side * 3), dtype=np.uint8).reshape(side, side, 3)
+    out = io.BytesIO()
+    Image.fromarray(pixels).resize((side * 2, side * 2)).save(out, format="JPEG", quality=85)
+    return out.getvalue(), f"photo_{index}.jpg"
+
+
+def generate_diary(repo, seed=0, dashboard=DEFAULTS["dashboard"], calendar=DEFAULTS["calendar"], years=DEFAULTS["years"],
+                   recurring=DEFAULTS["recurring"], drawings=DEFAULTS["drawings"], attachments=DEFAULTS["attachments"],
+                   attachment_size=DEFAULTS["attachment_size"], trashed=DEFAULTS["trashed"], first_year=2025):
+    # Returns the number of notes written per kind
+    rng = random.Random(seed)
+    now = datetime(first_year, 1, 1)
+    first_day, span = date(first_year, 1, 1), (date(first_year + years, 1, 1) - date(first_year, 1, 1)).days
+
+    def day(offset=None):
+        return (first_day + timedelta(days=rng.randrange(span) if offset is None else offset)).strftime("%Y-%m-%d")
+
+    ids = []
+    for i in range(dashboard):
+        doc = _base(rng, now + timedelta(minutes=i))
+        doc["pinned"] = rng.random() < 0.05
+        ids.append(repo.create_note(doc))
+    for i in range(calendar):
+        ids.append(repo.create_note(_base(rng, now + timedelta(minutes=i), day())))
+    for i in range(recurring):
+        start = day(rng.randrange(min(span, 365)))
+        doc = _base(rng, now + timedelta(minutes=i), start)
+        doc.update(series_fields(start, "yearly"))
+        repo.create_note(doc)
+    for i in range(drawings):
+        fabric, png = _drawing(rng)
+        doc = _base(rng, now + timedelta(minutes=i), day() if i % 2 else None)
+        doc.update(tipo="disegno", contenuto="Drawing", drawing_json=fabric)
+        repo.create_note(doc, png, "drawing.png")
+    for i in range(attachments):
+        data, name = _attachment(rng, attachment_size, i)
+        repo.create_note(_base(rng, now + timedelta(minutes=i), day() if i % 3 == 0 else None), data, name)
+    for note_id in rng.sample(ids, min(trashed, len(ids))):
+        repo.move_to_trash(note_id)
+    return {"dashboard": dashboard, "calendar": calendar, "recurring": recurring, "drawings": drawings,
+            "attachments": attachments, "trashed": min(trashed, len(ids))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic diary into a note store")
+    parser.add_argument("--db", default="bench_diary.db", help="SQLite file to fill (ignored with --mongo)")
+    parser.add_argument("--mongo", help="MongoDB connection string; fills diario_db there instead")
+    parser.add_argument("--seed", type=int, default=0)
+    for name, value in DEFAULTS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value)
+    args = parser.parse_args()
+    settings = {"mongo": {"connection_string": args.mongo}} if args.mongo else {"storage": {"backend": "sqlite", "path": args.db}}
+    repo = open_repository(settings)
+    repo.ensure_ready()
+    print(generate_diary(repo, args.seed, **{name: getattr(args, name) for name in DEFAULTS}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+from diary_gen import DEFAULTS, WORDS, generate_diary
+from sqlite_repository import SQLiteNoteRepository
+from storage import open_repository
+
+# Drives app.py headlessly with AppTest against a seeded SQLite diary and reports,
+# per scenario, the latency of the rerun each interaction causes, the storage
+# queries it ran and the bytes those queries returned.
+#   python bench/run_bench.py --save bench/baseline.json     record a baseline
+#   python bench/run_bench.py --baseline bench/baseline.json  exit 1 on a regression
+# Query counts are deterministic, so any increase is a regression; latency and
+# bytes only count past a tolerance, since timings vary from run to run.
+SCENARIOS = ("cold_start", "dashboard", "calendar_month", "search", "settings", "trash")
+LATENCY_TOLERANCE = 0.25
+LATENCY_FLOOR = 0.02
+BYTES_TOLERANCE = 0.10
+
+
+class Meter:
+    # Counts the SQLite backend's statements and the bytes of the rows they return
+    def __init__(self):
+        self.queries = 0
+        self.bytes_read = 0
+
+    def install(self):
+        execute, query, query_one = SQLiteNoteRepository._execute, SQLiteNoteRepository._query, SQLiteNoteRepository._query_one
+        meter = self
+
+        def counted_execute(repo, *args, **kwargs):
+            meter.queries += 1
+            return execute(repo, *args, **kwargs)
+
+        def measured_query(repo, *args, **kwargs):
+            rows = query(repo, *args, **kwargs)
+            meter.bytes_read += sum(_row_size(row) for row in rows)
+            return rows
+
+        def measured_query_one(repo, *args, **kwargs):
+            row = query_one(repo, *args, **kwargs)
+            if row is not None: meter.bytes_read += _row_size(row)
+            return row
+
+        SQLiteNoteRepository._execute = counted_execute
+        SQLiteNoteRepository._query = measured_query
+        SQLiteNoteRepository._query_one = measured_query_one
+
+    def reset(self):
+        self.queries = self.bytes_read = 0
+
+
+def _row_size(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row if v is not None)
+
+
+def seeded_database(seed, sizes, fresh=False):
+    # One file per seed and sizes, reused across runs since seeding takes a while
+    key = hashlib.sha256(json.dumps([seed, sizes], sort_keys=True).encode()).hexdigest()[:12]
+    path = Path(tempfile.gettempdir()) / f"diario-bench-{key}.db"
+    if fresh or not path.exists():
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{path}{suffix}").unlink(missing_ok=True)
+        repo = open_repository({"storage": {"backend": "sqlite", "path": str(path)}})
+        repo.ensure_ready()
+        started = time.perf_counter()
+        print(f"Seeding {path.name}: {generate_diary(repo, seed, **sizes)} in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+
+def _session(db_path):
+    at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=120)
+    at.secrets["storage"] = {"backend": "sqlite", "path": str(db_path)}
+    # The calendar opens on the first seeded month; each step then moves forward
+    at.session_state["cal_year"], at.session_state["cal_month"] = 2025, 1
+    return at
+
+
+# Each scenario returns what the next measured run() is called on.
+# cold_start is a new session's first run with the process caches emptied (repository
+# reopened, nothing cached), i.e. time to first interactive short of module imports;
+# the dashboard is a new session's first run on warm caches, the others are reruns.
+def _cold_start(at, i, db_path):
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    return _session(db_path)
+
+
+def _dashboard(at, i, db_path):
+    return _session(db_path)
+
+
+def _calendar_month(at, i, db_path):
+    return _button(at, "Next ▶").click()
+
+
+def _search(at, i, db_path):
+    terms = (WORDS[(i * 7) % len(WORDS)], f"{WORDS[i % len(WORDS)]} {WORDS[(i * 3) % len(WORDS)][:3]}")
+    return at.text_input(key="dash_search").input(terms[i % 2])
+
+
+def _settings(at, i, db_path):
+    return _button(at, "⚙").click()
+
+
+def _trash(at, i, db_path):
+    return _button(at, "🗑").click()
+
+
+STEPS = {"cold_start": _cold_start, "dashboard": _dashboard, "calendar_month": _calendar_month, "search": _search, "settings": _settings, "trash": _trash}
+
+
+def run_scenario(name, db_path, meter, repeats):
+    # Fresh session and empty st.cache_data, one untimed startup run, then 'repeats' measured reruns
+    st.cache_data.clear()
+    at = _session(db_path)
+    at.run()
+    samples = []
+    for i in range(repeats):
+        step = STEPS[name](at, i, db_path)
+        meter.reset()
+        started = time.perf_counter()
+        at = step.run()
+        samples.append({"latency": time.perf_counter() - started, "queries": meter.queries, "bytes": meter.bytes_read})
+        if at.exception: raise RuntimeError(f"{name}: {at.exception[0].value}")
+    latencies = sorted(s["latency"] for s in samples)
+    return {
+        "latency_median": statistics.median(latencies),
+        "latency_max": latencies[-1],
+        "queries": max(s["queries"] for s in samples),
+        "bytes": max(s["bytes"] for s in samples),
+    }
+
+
+def compare(results, baseline):
+    # Returns one line per metric that got worse than the baseline allows
+    problems = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not before: continue
+        if now["queries"] > before["queries"]:
+            problems.append(f"{name}: queries {before['queries']} -> {now['queries']}")
+        if now["bytes"] > before["bytes"] * (1 + BYTES_TOLERANCE):
+            problems.append(f"{name}: bytes {before['bytes']} -> {now['bytes']}")
+        slower = now["latency_median"] - before["latency_median"]
+        if slower > LATENCY_FLOOR and now["latency_median"] > before["latency_median"] * (1 + LATENCY_TOLERANCE):
+            problems.append(f"{name}: median rerun {before['latency_median'] * 1000:.0f} ms -> {now['latency_median'] * 1000:.0f} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app reruns on a seeded synthetic diary")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="run only these (repeatable)")
+    parser.add_argument("--fresh", action="store_true", help="reseed even if the dataset file exists")
+    parser.add_argument("--save", help="write the results as JSON (e.g. a new baseline)")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    for name, value in DEFAULTS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value)
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) for name in DEFAULTS}
+    db_path = seeded_database(args.seed, sizes, args.fresh)
+    meter = Meter()
+    meter.install()
+
+    results = {}
+    print(f"{'scenario':<16}{'median ms':>10}{'max ms':>9}{'queries':>9}{'KB read':>10}")
+    for name in args.scenario or SCENARIOS:
+        r = results[name] = run_scenario(name, db_path, meter, args.repeats)
+        print(f"{name:<16}{r['latency_median'] * 1000:>10.0f}{r['latency_max'] * 1000:>9.0f}{r['queries']:>9}{r['bytes'] / 1024:>10.1f}")
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({"seed": args.seed, "sizes": sizes, "results": results}, indent=2))
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline.get("seed") != args.seed or baseline.get("sizes") != sizes:
+            print("Baseline was recorded on a different dataset; comparing anyway")
+        problems = compare(results, baseline["results"])
+        for line in problems: print("REGRESSION", line)
+        if problems: sys.exit(1)
+        print("No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import hashlib
+from datetime import datetime, timedelta
+import bson.binary
+from pymongo import ASCENDING, UpdateOne
+
+# GridFS-style storage for attachments and drawings.
+# Blobs are keyed by the SHA-256 of their content, so a note and all of its
+# copies point at the same blob and an upload of known bytes writes nothing.
+# Garbage collection races with uploads that reuse a blob: every put stamps the
+# files document (touched_at) and every chunk write (written_at). A blob touched
+# within REUSE_GRACE is only marked 'orphaned' and swept later; a deletion only
+# removes chunks written before it started, so a concurrent rewrite survives.
+CHUNK_SIZE = 255 * 1024
+CHUNKS_PER_BATCH = 16
+REUSE_GRACE = timedelta(hours=1)
+
+
+def iter_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+        for i in range(0, len(data), CHUNK_SIZE):
+            yield data[i:i + CHUNK_SIZE]
+        return
+    source.seek(0)
+    while True:
+        piece = source.read(CHUNK_SIZE)
+        if not piece: break
+        yield piece
+
+
+class BlobStore:
+    def __init__(self, db, prefix="blobs"):
+        self.files = db[f"{prefix}.files"]
+        self.chunks = db[f"{prefix}.chunks"]
+
+    def ensure_indexes(self):
+        self.chunks.create_index([("files_id", ASCENDING), ("n", ASCENDING)], unique=True)
+        self.files.create_index([("touched_at", ASCENDING)], name="orphaned", partialFilterExpression={"orphaned": True})
+
+    def hash(self, source):
+        digest = hashlib.sha256()
+        for piece in iter_source(source):
+            digest.update(piece)
+        return digest.hexdigest()
+
+    def exists(self, blob_id):
+        return self.files.find_one({"_id": blob_id}, {"_id": 1}) is not None
+
+    def _touch(self, blob_id):
+        # exists() for an upload: a blob about to be referenced again is kept from collection for a while
+        return self.files.update_one({"_id": blob_id}, {"$set": {"touched_at": datetime.now()}}).matched_count > 0
+
+    # Stores bytes or a file-like object and returns its content hash
+    def put(self, source):
+        blob_id = self.hash(source)
+        if self._touch(blob_id): return blob_id
+        self._commit(blob_id, self._write(blob_id, iter_source(source)))
+        return blob_id
+
+    # Stores a non-seekable stream whose hash is already known (e.g. a backup member).
+    # The content is hashed while it is written and rejected if it doesn't match.
+    def put_stream(self, blob_id, stream):
+        if self._touch(blob_id): return blob_id
+        digest = hashlib.sha256()
+        def pieces():
+            while True:
+                piece = stream.read(CHUNK_SIZE)
+                if not piece: break
+                digest.update(piece)
+                yield piece
+        length = self._write(blob_id, pieces())
+        if digest.hexdigest() != blob_id:
+            self.chunks.delete_many({"files_id": blob_id})
+            raise ValueError(f"Blob content does not match its id {blob_id}")
+        self._commit(blob_id, length)
+        return blob_id
+
+    def _write(self, blob_id, pieces):
+        length, ops = 0, []
+        for n, piece in enumerate(pieces):
+            length += len(piece)
+            # Upserts keyed on (files_id, n) make concurrent uploads of the same bytes harmless
+            ops.append(UpdateOne({"files_id": blob_id, "n": n}, {"$setOnInsert": {"data": bson.binary.Binary(piece)}, "$set": {"written_at": datetime.now()}}, upsert=True))
+            if len(ops) >= CHUNKS_PER_BATCH:
+                self.chunks.bulk_write(ops, ordered=False)
+                ops = []
+        if ops: self.chunks.bulk_write(ops, ordered=False)
+        return length
+
+    def _commit(self, blob_id, length):
+        # The files document goes last: a blob is only visible once all its chunks are written
+        self.files.update_one({"_id": blob_id}, {"$setOnInsert": {"length": length, "chunk_size": CHUNK_SIZE}, "$set": {"touched_at": datetime.now()}}, upsert=True)
+
+    def iter_chunks(self, blob_id):
+        cursor = self.chunks.find({"files_id": blob_id}, {"data": 1}).sort("n", ASCENDING).batch_size(CHUNKS_PER_BATCH)
+        for chunk in cursor:
+            yield bytes(chunk["data"])
+
+    def read(self, blob_id):
+        if not blob_id: return None
+        return b"".join(self.iter_chunks(blob_id))
+
+    # Drops blobs no note points at any more (after hard deletes or file replacement).
+    # A blob can be a note's file or its thumbnail.
+    def delete_unreferenced(self, collection, blob_ids):
+        cutoff = datetime.now() - REUSE_GRACE
+        for blob_id in set(b for b in blob_ids if b):
+            if collection.find_one({"$or": [{"file_id": blob_id}, {"thumb_id": blob_id}]}, {"_id": 1}) is not None:
+                self.files.update_one({"_id": blob_id, "orphaned": True}, {"$unset": {"orphaned": ""}})
+                continue
+            started = datetime.now()
+            stale = {"$or": [{"touched_at": {"$lt": cutoff}}, {"touched_at": {"$exists": False}}]}
+            if self.files.delete_one({"_id": blob_id, **stale}).deleted_count:
+                self.chunks.delete_many({"files_id": blob_id, "$or": [{"written_at": {"$lt": started}}, {"written_at": {"$exists": False}}]})
+            else:
+                self.files.update_one({"_id": blob_id}, {"$set": {"orphaned": True}})
+
+    # Collects blobs skipped above once their grace period is over; returns how many were checked
+    def sweep_orphans(self, collection):
+        cutoff = datetime.now() - REUSE_GRACE
+        blob_ids = [d["_id"] for d in self.files.find({"orphaned": True, "touched_at": {"$lt": cutoff}}, {"_id": 1})]
+        self.delete_unreferenced(collection, blob_ids)
+        return len(blob_ids)
+
+
+# One-time move of legacy inline 'file_data' binaries into the blob store
+def migrate_inline_files(collection, store, batch_size=50):
+    moved, ops = 0, []
+    cursor = collection.find({"file_data": {"$exists": True}}, {"file_data": 1}).batch_size(batch_size)
+    for note in cursor:
+        data = note.get("file_data")
+        if data:
+            blob_id = store.put(bytes(data))
+            ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"file_id": blob_id, "file_size": len(data)}, "$unset": {"file_data": ""}}))
+            moved += 1
+        else:
+            ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"file_id": None}, "$unset": {"file_data": ""}}))
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
+    return moved
@@ -0,0 +1,32 @@
+from collections import OrderedDict
+
+# Per-session LRU cache for repository reads. Every entry remembers the
+# repository generation it was loaded at; any write through the app bumps the
+# generation, so stale entries are simply never served again.
+DEFAULT_MAX_ENTRIES = 32
+
+
+class QueryCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Results are shared between reruns: callers must treat them as read-only
+    def get_or_load(self, key, generation, loader):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        result = loader()
+        self._entries[key] = (generation, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,56 @@
+import io
+import numpy as np
+from PIL import Image
+import writequeue
+
+# PNG encoding for st_canvas drawings. The canvas hands back every pixel of its
+# area, mostly blank, so the encoder keeps only the bounding box of the strokes
+# (plus a small margin) and writes a palette PNG whenever the drawing has at
+# most 256 distinct colours, which is exact, not an approximation.
+# The editable form of a drawing is drawing_json, so cropping loses nothing.
+MARGIN = 8
+MAX_PALETTE = 256
+
+
+def _ink_box(rgba):
+    # Blank means fully transparent or opaque white (the canvas background)
+    alpha = rgba[..., 3]
+    white = (rgba[..., 0] == 255) & (rgba[..., 1] == 255) & (rgba[..., 2] == 255)
+    ink = (alpha > 0) & ~((alpha == 255) & white)
+    rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if not len(rows): return None
+    h, w = ink.shape
+    return max(rows[0] - MARGIN, 0), min(rows[-1] + 1 + MARGIN, h), max(cols[0] - MARGIN, 0), min(cols[-1] + 1 + MARGIN, w)
+
+
+def _to_palette(rgba):
+    # Exact palette conversion: one entry per distinct RGBA value, alpha via tRNS
+    packed = np.ascontiguousarray(rgba).view(np.uint32)[..., 0]
+    colors, index = np.unique(packed, return_inverse=True)
+    if len(colors) > MAX_PALETTE: return None
+    entries = colors.view(np.uint8).reshape(-1, 4)
+    img = Image.fromarray(index.reshape(packed.shape).astype(np.uint8), "P")
+    img.putpalette(entries[:, :3].tobytes(), rawmode="RGB")
+    if (entries[:, 3] < 255).any(): img.info["transparency"] = entries[:, 3].tobytes()
+    return img
+
+
+def encode_drawing(image_data):
+    rgba = np.asarray(image_data).astype(np.uint8)
+    box = _ink_box(rgba)
+    if box is None:
+        rgba = np.zeros((1, 1, 4), np.uint8)
+    else:
+        top, bottom, left, right = box
+        rgba = rgba[top:bottom, left:right]
+    img = _to_palette(rgba)
+    if img is None: img = Image.fromarray(rgba, "RGBA")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+# Encodes and saves on the write queue: save(png_bytes) does the write.
+# Returns a Future; its result is whatever save returned.
+def save_drawing(image_data, save):
+    return writequeue.submit(lambda: save(encode_drawing(image_data)))
@@ -0,0 +1,110 @@
+import logging
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+# One index per query shape the app issues against diario_db.note.
+# Key order follows equality -> sort -> range so the sort never happens in memory.
+NOTE_INDEXES = [
+    # Dashboard grid: {calendar_date: None, deleted: {$ne: True}} sorted by custom_order
+    IndexModel([("calendar_date", ASCENDING), ("custom_order", ASCENDING), ("deleted", ASCENDING)], name="dash_order"),
+    # Dashboard pages: keyset on (custom_order, _id) after the pinned split
+    IndexModel([("calendar_date", ASCENDING), ("pinned", ASCENDING), ("custom_order", ASCENDING), ("_id", ASCENDING)], name="dash_page"),
+    # Calendar month: calendar_date range + deleted
+    IndexModel([("calendar_date", ASCENDING), ("deleted", ASCENDING)], name="cal_date"),
+    # find_one(sort=[("custom_order", -1)]) on every save
+    IndexModel([("custom_order", DESCENDING)], name="last_order"),
+    # Recurring series that can fall in a month (multikey on recur_months), only series are indexed
+    IndexModel([("recur_months", ASCENDING), ("calendar_date", ASCENDING)], name="recur_series",
+               partialFilterExpression={"recur_months": {"$exists": True}}),
+    # Trash tabs: deleted notes by calendar_date, most recently deleted first, keyset on _id
+    IndexModel([("calendar_date", ASCENDING), ("deleted_at", DESCENDING), ("_id", DESCENDING)], name="trash_page",
+               partialFilterExpression={"deleted": True}),
+    # Background purge of expired trash
+    IndexModel([("deleted_at", ASCENDING)], name="trash_expiry",
+               partialFilterExpression={"deleted": True}),
+    # Search: multikey word index, serves exact words and anchored prefixes
+    IndexModel([("search_terms", ASCENDING), ("calendar_date", ASCENDING)], name="search_terms"),
+    # Restore dedupe and the post-restore ordering pass
+    IndexModel([("fingerprint", ASCENDING)], name="fingerprint",
+               partialFilterExpression={"fingerprint": {"$exists": True}}),
+    IndexModel([("restore_tag", ASCENDING)], name="restore_tag",
+               partialFilterExpression={"restore_tag": {"$exists": True}}),
+    # Blob reference checks after hard deletes
+    IndexModel([("file_id", ASCENDING)], name="file_ref",
+               partialFilterExpression={"file_id": {"$exists": True}}),
+    IndexModel([("thumb_id", ASCENDING)], name="thumb_ref",
+               partialFilterExpression={"thumb_id": {"$exists": True}}),
+]
+
+
+def query_shapes():
+    now = datetime.now()
+    month_start = f"{now.year}-{now.month:02d}-01"
+    month_end = f"{now.year}-{now.month:02d}-31"
+    return {
+        "dashboard": ({"deleted": {"$ne": True}, "calendar_date": None}, [("custom_order", ASCENDING)]),
+        "dashboard_page": ({"deleted": {"$ne": True}, "calendar_date": None, "pinned": False,
+                            "$or": [{"custom_order": {"$gt": 0}}, {"custom_order": 0, "_id": {"$gt": 0}}]},
+                           [("custom_order", ASCENDING), ("_id", ASCENDING)]),
+        "last_order": ({}, [("custom_order", DESCENDING)]),
+        "calendar_month": ({"calendar_date": {"$gte": month_start, "$lte": month_end}, "deleted": {"$ne": True}, "recurrence": None}, None),
+        "calendar_recurring": ({"recur_months": now.month, "calendar_date": {"$lte": month_end}, "deleted": {"$ne": True},
+                                "$or": [{"recur_until": None}, {"recur_until": {"$gte": month_start}}]}, None),
+        "trash_dashboard": ({"deleted": True, "calendar_date": None}, [("deleted_at", DESCENDING), ("_id", DESCENDING)]),
+        "trash_calendar": ({"deleted": True, "calendar_date": {"$ne": None}}, [("deleted_at", DESCENDING), ("_id", DESCENDING)]),
+        "trash_expiry": ({"deleted": True, "deleted_at": {"$lt": now}}, None),
+        "search": ({"deleted": {"$ne": True}, "calendar_date": None,
+                    "$and": [{"search_terms": "diario"}, {"search_terms": {"$regex": "^no"}}]}, [("custom_order", ASCENDING)]),
+        "restore_dedupe": ({"fingerprint": {"$in": ["0" * 64]}}, None),
+        "file_ref": ({"$or": [{"file_id": "0" * 64}, {"thumb_id": "0" * 64}]}, None),
+    }
+
+
+def _stages(plan):
+    if not isinstance(plan, dict): return
+    if "stage" in plan: yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan: yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+# Paged by keyset, so their order has to come from the index; other shapes may sort small results in memory
+INDEX_SORTED = ("dashboard", "dashboard_page")
+
+
+def unindexed_queries(collection):
+    # Shapes whose plan scans the collection, or sorts in memory where INDEX_SORTED says it must not
+    scans = []
+    for name, (filter_query, sort) in query_shapes().items():
+        cursor = collection.find(filter_query, {"_id": 1})
+        if sort: cursor = cursor.sort(sort)
+        try:
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        except (OperationFailure, KeyError) as e:
+            log.warning("Could not explain query %s: %s", name, e)
+            continue
+        stages = set(_stages(plan))
+        if "COLLSCAN" in stages or (name in INDEX_SORTED and "SORT" in stages): scans.append(name)
+    return scans
+
+
+def ensure_indexes(collection, blob_store=None):
+    existing = set(collection.index_information())
+    missing = [model for model in NOTE_INDEXES if model.document["name"] not in existing]
+    if missing:
+        try:
+            collection.create_indexes(missing)
+            log.info("Created indexes: %s", ", ".join(m.document["name"] for m in missing))
+        except OperationFailure as e:
+            # An equivalent index under another name (or with other options) already exists
+            log.warning("Index creation failed: %s", e)
+    if blob_store is not None: blob_store.ensure_indexes()
+
+    scans = unindexed_queries(collection)
+    for name in scans:
+        log.warning("Query '%s' still runs as a collection scan or an in-memory sort", name)
+    return scans
@@ -0,0 +1,98 @@
+import logging
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from blobstore import migrate_inline_files
+from search import backfill_search_fields
+from thumbnails import backfill_thumbnails
+from recurrence import upgrade_legacy_series
+
+log = logging.getLogger(__name__)
+
+# Versioned schema migrations. The applied version lives in diario_db.meta, so a
+# step runs once per database; run_migrations itself is called once per process.
+SCHEMA_DOC_ID = "schema"
+
+
+def add_custom_order(collection, blobs):
+    # Notes without custom_order are appended after the existing ones, oldest first
+    last = collection.find_one({"custom_order": {"$exists": True}}, {"custom_order": 1}, sort=[("custom_order", -1)])
+    next_order = (last["custom_order"] + 1) if last else 0
+    ops = []
+    for note in collection.find({"custom_order": {"$exists": False}}, {"_id": 1}).sort("data", 1):
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"custom_order": next_order}}))
+        next_order += 1
+    if ops: collection.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def move_files_to_blob_store(collection, blobs):
+    return migrate_inline_files(collection, blobs)
+
+
+def add_search_fields(collection, blobs):
+    return backfill_search_fields(collection)
+
+
+def add_thumbnails(collection, blobs):
+    return backfill_thumbnails(collection, blobs)
+
+
+def add_recurrence_rules(collection, blobs):
+    # The month query now goes through recur_series; the yearly-only index is dead weight
+    try: collection.drop_index("recurring")
+    except OperationFailure: pass
+    return upgrade_legacy_series(collection)
+
+
+def add_deleted_at(collection, blobs):
+    # Trash retention now counts from deleted_at; notes already in the trash start counting today
+    try: collection.drop_index("trash")
+    except OperationFailure: pass
+    res = collection.update_many({"deleted": True, "deleted_at": {"$exists": False}}, {"$set": {"deleted_at": datetime.now()}})
+    return res.modified_count
+
+
+def add_trash_pages(collection, blobs):
+    # The trash is read in keyset pages now; trash_page replaces trash_deleted (same keys plus _id)
+    try: collection.drop_index("trash_deleted")
+    except OperationFailure: pass
+    return 0
+
+
+def add_pinned_flags(collection, blobs):
+    # Dashboard pages match pinned: False exactly (an index equality, unlike $ne), so every note needs the field
+    res = collection.update_many({"pinned": {"$nin": [True, False]}}, {"$set": {"pinned": False}})
+    return res.modified_count
+
+
+MIGRATIONS = [
+    (1, "custom_order", add_custom_order),
+    (2, "inline files to blob store", move_files_to_blob_store),
+    (3, "search fields", add_search_fields),
+    (4, "thumbnails", add_thumbnails),
+    (5, "recurrence rules", add_recurrence_rules),
+    (6, "trash deleted_at", add_deleted_at),
+    (7, "trash pages", add_trash_pages),
+    (8, "pinned as bool", add_pinned_flags),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(db):
+    doc = db.meta.find_one({"_id": SCHEMA_DOC_ID})
+    return doc["version"] if doc else 0
+
+
+def run_migrations(db, collection, blobs):
+    version = schema_version(db)
+    applied = []
+    for step_version, name, step in MIGRATIONS:
+        if step_version <= version: continue
+        changed = step(collection, blobs)
+        # Steps are idempotent, so recording the version after each one is enough
+        # to resume cleanly if the process dies mid-way
+        db.meta.update_one({"_id": SCHEMA_DOC_ID}, {"$set": {"version": step_version}}, upsert=True)
+        log.info("Migration %s (%s) applied, %s notes changed", step_version, name, changed)
+        applied.append(name)
+    return applied
@@ -0,0 +1,138 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from bson import encode
+from pymongo import monitoring
+
+# Opt-in per-rerun instrumentation. app.py starts a run at the top of the script
+# when the panel is on; until then every hook below is a single attribute check.
+# A session's script runs on its own thread, so the current run is thread-local:
+# storage commands and timers are attributed to the rerun that issued them, and
+# writequeue workers (no run) are not counted.
+#   ops     storage commands by name, with the bytes sent and received
+#   timers  name -> [total seconds, calls]; nested timers are inclusive
+LOG_PATH = "perf_log.jsonl"
+MAX_RUNS = 30
+
+_local = threading.local()
+
+
+class Run:
+    def __init__(self, number):
+        self.number = number
+        self.started_at = datetime.now()
+        self.started = self.last = time.perf_counter()
+        self.finished = False
+        self.ops = {}
+        self.timers = {}
+
+    def add_op(self, name, sent=0, received=0, calls=1):
+        op = self.ops.setdefault(name, [0, 0, 0])
+        op[0] += calls
+        op[1] += sent
+        op[2] += received
+        self.last = time.perf_counter()
+
+    def add_time(self, name, seconds):
+        timer = self.timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+        self.last = time.perf_counter()
+
+    def summary(self):
+        # Plain dict for the panel and the log file; an unfinished run (st.rerun/st.stop) ends at its last event
+        return {
+            "run": self.number, "at": self.started_at.strftime("%Y-%m-%d %H:%M:%S"), "complete": self.finished,
+            "total_ms": round((self.last - self.started) * 1000, 1),
+            "ops": sum(op[0] for op in self.ops.values()),
+            "bytes_sent": sum(op[1] for op in self.ops.values()),
+            "bytes_received": sum(op[2] for op in self.ops.values()),
+            "by_command": {name: {"count": op[0], "sent": op[1], "received": op[2]} for name, op in self.ops.items()},
+            "timers_ms": {name: {"total": round(t[0] * 1000, 2), "calls": t[1]} for name, t in self.timers.items()},
+        }
+
+
+def current():
+    return getattr(_local, "run", None)
+
+
+def start_run(runs):
+    # runs: the session's deque of recent Run objects; the new run is appended to it
+    run = Run(runs[-1].number + 1 if runs else 1)
+    runs.append(run)
+    _local.run = run
+    return run
+
+
+def finish_run():
+    run = current()
+    if run is None: return
+    run.last = time.perf_counter()
+    run.finished = True
+    _local.run = None
+
+
+def stop_recording():
+    _local.run = None
+
+
+@contextmanager
+def timer(name):
+    run = current()
+    if run is None:
+        yield
+        return
+    started = time.perf_counter()
+    try: yield
+    finally: run.add_time(name, time.perf_counter() - started)
+
+
+def timed(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            run = current()
+            if run is None: return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try: return fn(*args, **kwargs)
+            finally: run.add_time(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def record_op(name, sent=0, received=0, calls=1):
+    # For backends without command monitoring (SQLite); calls=0 adds bytes to an op already counted
+    run = current()
+    if run is not None: run.add_op(name, sent, received, calls)
+
+
+class CommandMonitor(monitoring.CommandListener):
+    # Registered on the MongoClient. Events fire on the thread that ran the command;
+    # sizes are the BSON length of the command and of the reply (cursor batches included)
+    def started(self, event):
+        run = current()
+        if run is None: return
+        _local.pending = getattr(_local, "pending", {})
+        _local.pending[event.request_id] = len(encode(event.command))
+
+    def succeeded(self, event):
+        run = current()
+        if run is None: return
+        sent = getattr(_local, "pending", {}).pop(event.request_id, 0)
+        run.add_op(event.command_name, sent, len(encode(event.reply)))
+
+    def failed(self, event):
+        run = current()
+        if run is None: return
+        run.add_op(f"{event.command_name} (failed)", getattr(_local, "pending", {}).pop(event.request_id, 0))
+
+
+def export_runs(runs, path=LOG_PATH):
+    # Appends the recorded runs as JSON lines; returns how many were written
+    with open(path, "a", encoding="utf-8") as log_file:
+        for run in runs:
+            log_file.write(json.dumps(run.summary(), ensure_ascii=False) + "\n")
+    return len(runs)
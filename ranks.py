@@ -0,0 +1,63 @@
+import logging
+import threading
+from pymongo import UpdateOne
+
+log = logging.getLogger(__name__)
+
+# Fractional ranks for custom_order: a note moved between two others takes the
+# midpoint of their ranks, so a move writes only the moved note. Integers stay
+# valid ranks, so existing orders need no conversion and sorting is unchanged.
+# When two neighbours get closer than MIN_GAP the ranks are renumbered
+# 0, 1, 2, ... in a background thread.
+MIN_GAP = 1e-6
+
+_rebalance_lock = threading.Lock()
+
+
+def rank_between(before, after):
+    if before is None and after is None: return 0
+    if before is None: return after - 1
+    if after is None: return before + 1
+    return (before + after) / 2
+
+
+def move_before(collection, scope, target, moving_id, fields=None, on_rebalance=None):
+    # Writes the moved note's new rank (plus any other fields) and only then schedules a renumbering
+    # its neighbours have grown too close: a rebalance started earlier would read the old order
+    new_rank, crowded = rank_before(collection, scope, target, moving_id, on_rebalance)
+    collection.update_one({"_id": moving_id}, {"$set": {**(fields or {}), "custom_order": new_rank}})
+    if crowded: schedule_rebalance(collection, scope, on_rebalance)
+    return new_rank
+
+
+def rank_before(collection, scope, target, moving_id, on_rebalance=None):
+    # Rank for a note placed right before 'target' (a note with _id and custom_order), within scope,
+    # and whether it lands closer than MIN_GAP to its predecessor
+    target_rank = target["custom_order"]
+    prev = collection.find_one(
+        {**scope, "custom_order": {"$lt": target_rank}, "_id": {"$ne": moving_id}},
+        {"custom_order": 1}, sort=[("custom_order", -1)]
+    )
+    prev_rank = prev["custom_order"] if prev else None
+    new_rank = rank_between(prev_rank, target_rank)
+    if prev_rank is not None and new_rank in (prev_rank, target_rank):
+        # Float precision exhausted: renumber now, then there is room again
+        rebalance(collection, scope, on_rebalance)
+        target = collection.find_one({"_id": target["_id"]}, {"custom_order": 1})
+        return rank_before(collection, scope, target, moving_id, on_rebalance)
+    return new_rank, prev_rank is not None and target_rank - prev_rank < MIN_GAP
+
+
+# on_done lets the caller react to the renumbering (e.g. invalidate cached reads)
+def rebalance(collection, scope, on_done=None):
+    with _rebalance_lock:
+        ops = [UpdateOne({"_id": n["_id"]}, {"$set": {"custom_order": i}})
+               for i, n in enumerate(collection.find(scope, {"_id": 1}).sort("custom_order", 1))]
+        if ops: collection.bulk_write(ops, ordered=False)
+        log.info("Rebalanced %s ranks", len(ops))
+    if on_done: on_done()
+
+
+def schedule_rebalance(collection, scope, on_done=None):
+    if _rebalance_lock.locked(): return
+    threading.Thread(target=rebalance, args=(collection, scope, on_done), daemon=True).start()
@@ -0,0 +1,184 @@
+import calendar
+import itertools
+from datetime import date, datetime, timedelta
+from pymongo import UpdateOne
+
+# Recurring calendar notes. A series is a single note: its calendar_date is the
+# first occurrence and the rule lives next to it:
+#   recurrence       "daily" | "weekly" | "monthly" | "yearly"
+#   recur_interval   every N days/weeks/months/years (default 1)
+#   recur_weekdays   weekly only: 0=Monday .. 6=Sunday (default: the start's weekday)
+#   recur_until      last possible date "YYYY-MM-DD" or None; COUNT is turned into it at save time
+#   recur_exdates    skipped dates
+#   recur_months     months the series can fall in, so a month query only reads matching series
+# Legacy yearly notes (cal_month/cal_day/recur_end_year) are upgraded by a migration.
+FREQUENCIES = ("daily", "weekly", "monthly", "yearly")
+WEEKDAY_CODES = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+RRULE_FREQ = {"DAILY": "daily", "WEEKLY": "weekly", "MONTHLY": "monthly", "YEARLY": "yearly"}
+DATE_FORMAT = "%Y-%m-%d"
+RULE_FIELDS = ("recurrence", "recur_interval", "recur_weekdays", "recur_until", "recur_exdates")
+
+
+def _day(value):
+    return datetime.strptime(value, DATE_FORMAT).date()
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def parse_rrule(text):
+    # RRULE subset: FREQ, INTERVAL, BYDAY (plain weekday codes), UNTIL, COUNT
+    rule = {}
+    for part in text.strip().removeprefix("RRULE:").split(";"):
+        if not part.strip(): continue
+        key, _, value = part.partition("=")
+        key, value = key.strip().upper(), value.strip().upper()
+        if key == "FREQ":
+            if value not in RRULE_FREQ: raise ValueError(f"Unsupported FREQ: {value}")
+            rule["freq"] = RRULE_FREQ[value]
+        elif key == "INTERVAL": rule["interval"] = int(value)
+        elif key == "BYDAY":
+            codes = [code.strip() for code in value.split(",")]
+            unknown = [code for code in codes if code not in WEEKDAY_CODES]
+            if unknown: raise ValueError(f"Unknown BYDAY code: {', '.join(unknown)} (use {','.join(WEEKDAY_CODES)})")
+            rule["weekdays"] = sorted({WEEKDAY_CODES.index(code) for code in codes})
+        elif key == "UNTIL": rule["until"] = datetime.strptime(value[:8], "%Y%m%d").strftime(DATE_FORMAT)
+        elif key == "COUNT": rule["count"] = int(value)
+        else: raise ValueError(f"Unsupported RRULE part: {key}")
+    if "freq" not in rule: raise ValueError("RRULE needs a FREQ")
+    # Only weekly series store weekdays; anything else would be saved silently without them
+    if "weekdays" in rule and rule["freq"] != "weekly": raise ValueError("BYDAY is only supported with FREQ=WEEKLY")
+    if rule.get("interval", 1) < 1: raise ValueError("INTERVAL must be at least 1")
+    return rule
+
+
+def _iter_dates(freq, interval, start, weekdays, lo, hi):
+    # Occurrences of the rule between lo and hi (inclusive), without walking from the start
+    lo = max(lo, start)
+    if lo > hi: return
+    if freq == "daily":
+        d = start + timedelta(days=_ceil_div((lo - start).days, interval) * interval)
+        while d <= hi:
+            yield d
+            d += timedelta(days=interval)
+    elif freq == "weekly":
+        week0 = start - timedelta(days=start.weekday())
+        # Start from the active week that contains lo, or the last one before it
+        w = ((lo - week0).days // 7) // interval * interval
+        while True:
+            week_start = week0 + timedelta(weeks=w)
+            if week_start > hi: return
+            for wd in weekdays or [start.weekday()]:
+                d = week_start + timedelta(days=wd)
+                if lo <= d <= hi: yield d
+            w += interval
+    elif freq == "monthly":
+        m = max(_ceil_div((lo.year - start.year) * 12 + lo.month - start.month, interval) * interval, 0)
+        while True:
+            y, mo = divmod(start.month - 1 + m, 12)
+            y, mo = start.year + y, mo + 1
+            if date(y, mo, 1) > hi: return
+            if start.day <= calendar.monthrange(y, mo)[1]:
+                d = date(y, mo, start.day)
+                if lo <= d <= hi: yield d
+            m += interval
+    elif freq == "yearly":
+        n = max(_ceil_div(lo.year - start.year, interval) * interval, 0)
+        while start.year + n <= hi.year:
+            y = start.year + n
+            # A 29 February series only occurs in leap years
+            if start.month != 2 or start.day != 29 or calendar.isleap(y):
+                d = date(y, start.month, start.day)
+                if lo <= d <= hi: yield d
+            n += interval
+
+
+def _months(freq, interval, start):
+    if freq == "yearly": return [start.month]
+    if freq == "monthly": return sorted({(start.month - 1 + i * interval) % 12 + 1 for i in range(12)})
+    return list(range(1, 13))
+
+
+def series_fields(start_str, freq, interval=1, weekdays=None, until=None, count=None, exdates=None):
+    # Stored fields for a series starting on start_str; cal_month/cal_day stay for older readers
+    if freq not in FREQUENCIES: raise ValueError(f"Unknown recurrence: {freq}")
+    start = _day(start_str)
+    weekdays = sorted(set(weekdays)) if freq == "weekly" and weekdays else None
+    if count:
+        dates = _iter_dates(freq, interval, start, weekdays, start, date.max - timedelta(days=366))
+        last = next(itertools.islice(dates, count - 1, None), None)
+        if last and (until is None or last.strftime(DATE_FORMAT) < until): until = last.strftime(DATE_FORMAT)
+    return {
+        "recurrence": freq, "recur_interval": interval, "recur_weekdays": weekdays,
+        "recur_until": until, "recur_exdates": sorted(exdates or []),
+        "recur_months": _months(freq, interval, start),
+        "cal_month": start.month, "cal_day": start.day,
+    }
+
+
+def rule_from_note(note):
+    return {
+        "freq": note["recurrence"], "interval": note.get("recur_interval") or 1,
+        "weekdays": note.get("recur_weekdays"), "until": note.get("recur_until"),
+        "exdates": note.get("recur_exdates"),
+    }
+
+
+def reanchor(note, start_str):
+    # Series fields after the series is moved or copied to a new first date
+    rule = rule_from_note(note)
+    if rule["freq"] == "weekly" and rule["weekdays"] == [_day(note["calendar_date"]).weekday()]: rule["weekdays"] = None
+    return series_fields(start_str, rule["freq"], rule["interval"], rule["weekdays"], rule["until"], exdates=rule["exdates"])
+
+
+def occurrences(note, first, last):
+    # Dates (strings) of one series between first and last (date objects), exceptions removed
+    rule = rule_from_note(note)
+    hi = min(last, _day(rule["until"])) if rule["until"] else last
+    skipped = set(rule["exdates"] or [])
+    dates = _iter_dates(rule["freq"], rule["interval"], _day(note["calendar_date"]), rule["weekdays"], first, hi)
+    return [s for s in (d.strftime(DATE_FORMAT) for d in dates) if s not in skipped]
+
+
+def expand(series, first_str, last_str):
+    # One pass over the series that overlap a date range -> [(date_str, note)], in date order
+    first, last = _day(first_str), _day(last_str)
+    out = [(d, note) for note in series for d in occurrences(note, first, last)]
+    out.sort(key=lambda pair: pair[0])
+    return out
+
+
+def describe(note):
+    rule = rule_from_note(note)
+    unit = {"daily": "day", "weekly": "week", "monthly": "month", "yearly": "year"}[rule["freq"]]
+    if rule["interval"] == 1: text = {"daily": "Daily", "weekly": "Weekly", "monthly": "Monthly", "yearly": "Annual"}[rule["freq"]]
+    else: text = f"Every {rule['interval']} {unit}s"
+    if rule["freq"] == "weekly" and rule["weekdays"]: text += " on " + ", ".join(calendar.day_abbr[d] for d in rule["weekdays"])
+    if rule["until"]: text += f" until {rule['until']}"
+    return text
+
+
+# Migration: legacy yearly notes get the stored series fields. recur_end_year was
+# exclusive (shown while year < recur_end_year), so it becomes 31 Dec of the year before.
+def legacy_series_fields(note):
+    # Series fields for a note saved before recur_months existed (migration, restored old backups); None otherwise
+    if "recur_months" in note or note.get("recurrence") not in FREQUENCIES or not note.get("calendar_date"): return None
+    end_year = note.get("recur_end_year")
+    return series_fields(note["calendar_date"], note["recurrence"], until=f"{end_year - 1}-12-31" if end_year else None)
+
+
+def upgrade_legacy_series(collection, batch_size=200):
+    upgraded, ops = 0, []
+    cursor = collection.find({"recurrence": {"$nin": [None]}, "recur_months": {"$exists": False}},
+                             {"recurrence": 1, "calendar_date": 1, "recur_end_year": 1}).batch_size(batch_size)
+    for note in cursor:
+        fields = legacy_series_fields(note)
+        if fields is None: continue
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": fields}))
+        upgraded += 1
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
+    return upgraded
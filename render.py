@@ -0,0 +1,65 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+import perf
+
+# Quill HTML -> display HTML. app.py runs top to bottom on every rerun, so the
+# patterns are compiled here once per process, and the result for a given
+# content is memoized: a rerun re-renders notes without re-parsing them.
+# The memo is keyed by a hash of the content (an edited note simply gets a new
+# entry) and bounded by the characters it holds, not by entry count: content can
+# embed base64 images. Content larger than MAX_MEMO_CHARS is rendered every time.
+MAX_RENDERED_CHARS = 32 * 1024 * 1024
+MAX_MEMO_CHARS = 256 * 1024
+
+_rendered = OrderedDict()  # sha1 of the content -> display HTML
+_rendered_chars = 0
+_rendered_lock = threading.Lock()
+
+LINK_RE = re.compile(r'<a href="(.*?)"')
+LINK_SUB = r'<a href="\1" target="_blank" style="color: #1E90FF !important; text-decoration: underline !important; cursor: pointer;" rel="noopener noreferrer"'
+UNCHECKED_RE = re.compile(r'<li data-list="unchecked">(.*?)</li>', re.DOTALL)
+UNCHECKED_SUB = r'<div style="display: flex; align-items: flex-start; margin-bottom: 4px; margin-left: 5px;"><span style="margin-right: 10px; font-size: 1.2em; color: #555; line-height: 1.2;">&#9744;</span><span>\1</span></div>'
+CHECKED_RE = re.compile(r'<li data-list="checked">(.*?)</li>', re.DOTALL)
+CHECKED_SUB = r'<div style="display: flex; align-items: flex-start; margin-bottom: 4px; margin-left: 5px; color: #888; text-decoration: line-through;"><span style="margin-right: 10px; font-size: 1.2em; color: #333; text-decoration: none; line-height: 1.2;">&#9745;</span><span>\1</span></div>'
+QL_UI_SPAN = '<span class="ql-ui" contenteditable="false"></span>'
+FORMULA_RE = re.compile(r'<span class="ql-formula"[^>]*?data-value="(?P<formula>.+?)"[^>]*?>.*?</span>', re.DOTALL)
+
+
+@perf.timed("process_content_for_display")
+def process_content_for_display(html_content):
+    global _rendered_chars
+    if not html_content: return ""
+    if len(html_content) > MAX_MEMO_CHARS: return _render(html_content)
+    key = hashlib.sha1(html_content.encode("utf-8", "surrogatepass")).digest()
+    with _rendered_lock:
+        cached = _rendered.get(key)
+        if cached is not None:
+            _rendered.move_to_end(key)
+            return cached
+    result = _render(html_content)
+    with _rendered_lock:
+        if key not in _rendered:
+            _rendered[key] = result
+            _rendered_chars += len(result)
+        while _rendered_chars > MAX_RENDERED_CHARS:
+            _rendered_chars -= len(_rendered.popitem(last=False)[1])
+    return result
+
+
+def _render(html_content):
+    # Plain paragraphs (the common case) have nothing to rewrite: skip the regex passes
+    if "<a href" in html_content: html_content = LINK_RE.sub(LINK_SUB, html_content)
+    html_content = html_content.replace(QL_UI_SPAN, '')
+    if "data-list=" in html_content:
+        html_content = UNCHECKED_RE.sub(UNCHECKED_SUB, html_content)
+        html_content = CHECKED_RE.sub(CHECKED_SUB, html_content)
+    html_content = html_content.replace('<ul>', '').replace('</ul>', '')
+    return html_content
+
+
+def flatten_formulas_to_text(html_content):
+    if not html_content: return ""
+    if "ql-formula" not in html_content: return html_content
+    return FORMULA_RE.sub(r' $$\g<formula>$$ ', html_content)
@@ -0,0 +1,442 @@
+import functools
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+from blobstore import BlobStore
+from indexes import ensure_indexes
+from migrations import run_migrations
+from search import build_search_filter, rank_notes, search_fields
+from thumbnails import make_thumbnail
+from backup import build_backup, restore_backup
+from ranks import move_before
+from recurrence import RULE_FIELDS, expand, reanchor
+
+log = logging.getLogger(__name__)
+
+# Fields needed to list a note (titles, badges, ordering, calendar placement).
+# Blobs (attachment bytes, drawing_json) stay on the server until a note actually needs them.
+SUMMARY_FIELDS = {
+    "titolo": 1, "contenuto": 1, "labels": 1, "tipo": 1, "data": 1, "file_name": 1, "file_id": 1, "thumb_id": 1,
+    "deleted": 1, "deleted_at": 1, "pinned": 1, "is_default": 1, "custom_order": 1,
+    "calendar_date": 1, "recurrence": 1, "cal_month": 1, "cal_day": 1, "recur_end_year": 1,
+    "recur_interval": 1, "recur_weekdays": 1, "recur_until": 1, "recur_exdates": 1
+}
+
+# Search ranking reads the plain-text search fields, never contenuto (which can hold inline images)
+RANK_FIELDS = {"titolo": 1, "labels": 1, "search_text": 1, "custom_order": 1}
+
+# Month grid cells: titles, icons and placement only, no content
+GRID_FIELDS = {f: 1 for f in (
+    "titolo", "labels", "tipo", "file_name", "is_default", "custom_order",
+    "calendar_date", *RULE_FIELDS
+)}
+
+DASHBOARD_SCOPE = {"deleted": {"$ne": True}, "calendar_date": None}
+DASHBOARD_PAGE_SIZE = 24
+TRASH_FIELDS = {f: 1 for f in ("titolo", "tipo", "file_name", "calendar_date", "deleted_at")}
+TRASH_PAGE_SIZE = 20
+# App-wide settings document in diario_db.meta (next to the schema version)
+SETTINGS_DOC_ID = "settings"
+
+# "Compiti del giorno" notes stay virtual until someone edits them. Their _id is
+# derived from the date, so the first save is an idempotent upsert.
+DEFAULT_NOTE_PREFIX = "default:"
+
+
+def virtual_day_note(date_str):
+    return {
+        "_id": f"{DEFAULT_NOTE_PREFIX}{date_str}",
+        "titolo": "Compiti del giorno",
+        "contenuto": "",
+        "labels": [],
+        "data": datetime.now(),
+        "custom_order": -1,
+        "tipo": "testo_ricco",
+        "deleted": False, "pinned": False,
+        "calendar_date": date_str,
+        "is_default": True,
+        "search_text": "", "search_terms": ["compiti", "del", "giorno"],
+        "is_virtual": True
+    }
+
+
+def is_virtual_note(note_id):
+    return isinstance(note_id, str) and note_id.startswith(DEFAULT_NOTE_PREFIX)
+
+
+# Collection methods that each cost (at least) one server round trip
+ROUND_TRIP_METHODS = {
+    "find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one", "update_many",
+    "delete_one", "delete_many", "bulk_write", "aggregate", "distinct", "count_documents",
+    "create_index", "create_indexes", "index_information"
+}
+
+
+class _CountedCollection:
+    # Transparent pymongo Collection proxy that reports each round trip to the repository
+    def __init__(self, collection, repo):
+        self._collection = collection
+        self._repo = repo
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in ROUND_TRIP_METHODS: return attr
+        def counted(*args, **kwargs):
+            self._repo._count_trip()
+            return attr(*args, **kwargs)
+        return counted
+
+
+def action(fn=None, writes=False):
+    # Marks a repository method as one user action: its round trips are counted together.
+    # Actions that write bump the repository generation, which invalidates cached reads.
+    if fn is None: return functools.partial(action, writes=writes)
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        state = self._local
+        if getattr(state, "action", None): return fn(self, *args, **kwargs)
+        state.action, state.trips = fn.__name__, 0
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            if writes: self.bump_generation()
+            self.recent_actions.append((fn.__name__, state.trips))
+            log.debug("%s: %s round trips", fn.__name__, state.trips)
+            state.action = None
+    return wrapper
+
+
+class RepositoryBase:
+    # Action bookkeeping shared by the storage backends: round trips per action
+    # and the generation counter that write actions bump
+    def __init__(self):
+        self._local = threading.local()
+        self._generation_lock = threading.Lock()
+        self.generation = 0
+        self.recent_actions = deque(maxlen=50)
+
+    def bump_generation(self):
+        with self._generation_lock:
+            self.generation += 1
+
+    def _count_trip(self, n=1):
+        if getattr(self._local, "action", None): self._local.trips += n
+
+
+class NoteRepository(RepositoryBase):
+    # Owns every read and write of diario_db.note and its blobs. Each public
+    # method is one user action; multi-document writes go out as a single
+    # bulk_write, or a transaction where the result must be all-or-nothing.
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.notes = _CountedCollection(db.note, self)
+        self.blobs = BlobStore(db)
+        self.blobs.files = _CountedCollection(self.blobs.files, self)
+        self.blobs.chunks = _CountedCollection(self.blobs.chunks, self)
+
+    def _supports_transactions(self):
+        return self.db.client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+    def _atomic(self, ops):
+        if not self._supports_transactions():
+            self.notes.bulk_write(ops)
+            return
+        with self.db.client.start_session() as session:
+            session.with_transaction(lambda s: self.notes.bulk_write(ops, session=s))
+        self._count_trip()  # commitTransaction
+
+    def _next_order(self):
+        last = self.notes.find_one({}, {"custom_order": 1}, sort=[("custom_order", DESCENDING)])
+        return (last["custom_order"] + 1) if last and "custom_order" in last else 0
+
+    def _purge(self, filter_query):
+        blob_ids = self.notes.distinct("file_id", filter_query) + self.notes.distinct("thumb_id", filter_query)
+        res = self.notes.delete_many(filter_query)
+        self.blobs.delete_unreferenced(self.notes, blob_ids)
+        return res.deleted_count
+
+    # --- SETUP ---
+
+    @action(writes=True)
+    def ensure_ready(self):
+        scans = ensure_indexes(self.notes, self.blobs)
+        applied = run_migrations(self.db, self.notes, self.blobs)
+        return scans, applied
+
+    # --- READS ---
+
+    @action
+    def dashboard_notes(self, query=None, limit=None):
+        # A search ranks every match on RANK_FIELDS, then loads full summaries for the first 'limit' only
+        filter_query = dict(DASHBOARD_SCOPE)
+        if not query:
+            cursor = self.notes.find(filter_query, SUMMARY_FIELDS).sort("custom_order", ASCENDING)
+            return list(cursor.limit(limit) if limit else cursor)
+        filter_query.update(build_search_filter(query))
+        ranked = rank_notes(list(self.notes.find(filter_query, RANK_FIELDS).sort("custom_order", ASCENDING)), query)[:limit]
+        by_id = {n["_id"]: n for n in self.notes.find({"_id": {"$in": [n["_id"] for n in ranked]}}, SUMMARY_FIELDS)}
+        return [by_id[n["_id"]] for n in ranked if n["_id"] in by_id]
+
+    # Keyset pagination: pinned notes first, then the rest, each by (custom_order, _id).
+    # 'after' is the cursor returned with the previous page, None for the first one;
+    # the returned cursor is None on the last page.
+    @action
+    def dashboard_page(self, after=None, limit=DASHBOARD_PAGE_SIZE):
+        notes = []
+        for pinned in (True, False):
+            if after and after[0] != pinned: continue
+            # pinned is always stored as a bool, so both halves are equality matches on dash_page
+            filter_query = dict(DASHBOARD_SCOPE, pinned=pinned)
+            if after:
+                _, order, last_id = after
+                filter_query["$or"] = [{"custom_order": {"$gt": order}}, {"custom_order": order, "_id": {"$gt": last_id}}]
+                after = None
+            cursor = self.notes.find(filter_query, SUMMARY_FIELDS).sort([("custom_order", ASCENDING), ("_id", ASCENDING)])
+            notes += cursor.limit(limit + 1 - len(notes))
+            if len(notes) > limit: break
+        if len(notes) <= limit: return notes, None
+        notes = notes[:limit]
+        last = notes[-1]
+        return notes, (bool(last.get("pinned")), last["custom_order"], last["_id"])
+
+    @action
+    def dashboard_candidates(self, exclude_id):
+        return list(self.notes.find({**DASHBOARD_SCOPE, "_id": {"$ne": exclude_id}}, {"titolo": 1, "pinned": 1}).sort("custom_order", ASCENDING))
+
+    # Returns (one-off notes of the month, [(date_str, note)] for every occurrence of a
+    # recurring note in the month). Only series that can fall in this month are read.
+    # compact=True fetches GRID_FIELDS only, for the month grid
+    @action
+    def month_notes(self, year, month, num_days, query=None, compact=False, first_day=1):
+        # Days first_day..num_days of the month (one day: first_day == num_days)
+        start_date_str = f"{year}-{month:02d}-{first_day:02d}"
+        end_date_str = f"{year}-{month:02d}-{num_days:02d}"
+        q_reg = {"calendar_date": {"$gte": start_date_str, "$lte": end_date_str}, "deleted": {"$ne": True}, "recurrence": None}
+        q_rec = {"recur_months": month, "calendar_date": {"$lte": end_date_str}, "deleted": {"$ne": True},
+                 "$or": [{"recur_until": None}, {"recur_until": {"$gte": start_date_str}}]}
+        if query:
+            search_filter = build_search_filter(query)
+            q_reg.update(search_filter)
+            q_rec.update(search_filter)
+        fields = GRID_FIELDS if compact else SUMMARY_FIELDS
+        return list(self.notes.find(q_reg, fields)), expand(self.notes.find(q_rec, fields), start_date_str, end_date_str)
+
+    @action
+    def trash_count(self, calendar):
+        return self.notes.count_documents({"deleted": True, "calendar_date": {"$ne": None} if calendar else None})
+
+    # Trash lists: titles and dates only, most recently deleted first, in keyset pages
+    # like dashboard_page. The cursor is (deleted_at, _id) of the last note, None on the last page.
+    @action
+    def trash_page(self, calendar, after=None, limit=TRASH_PAGE_SIZE):
+        filter_query = {"deleted": True, "calendar_date": {"$ne": None} if calendar else None}
+        if after:
+            deleted_at, last_id = after
+            # Day notes have string ids, which sort below ObjectIds: after an ObjectId they all still follow
+            same_time = {"_id": {"$lt": last_id}} if isinstance(last_id, str) else {"$or": [{"_id": {"$lt": last_id}}, {"_id": {"$type": "string"}}]}
+            filter_query["$or"] = [{"deleted_at": {"$lt": deleted_at}}, {"deleted_at": deleted_at, **same_time}]
+        cursor = self.notes.find(filter_query, TRASH_FIELDS).sort([("deleted_at", DESCENDING), ("_id", DESCENDING)])
+        notes = list(cursor.limit(limit + 1))
+        if len(notes) <= limit: return notes, None
+        notes = notes[:limit]
+        return notes, (notes[-1].get("deleted_at"), notes[-1]["_id"])
+
+    @action
+    def get_fields(self, note_id, *fields):
+        return self.notes.find_one({"_id": note_id}, {f: 1 for f in fields}) or {}
+
+    @action
+    def read_blob(self, blob_id):
+        return self.blobs.read(blob_id)
+
+    @action
+    def storage_stats(self):
+        pipeline = [
+            {"$project": {
+                "_id": 0,
+                "deleted": {"$eq": ["$deleted", True]},
+                "on_cal": {"$ne": [{"$ifNull": ["$calendar_date", None]}, None]},
+                "size": {"$bsonSize": "$$ROOT"}
+            }},
+            {"$group": {"_id": {"deleted": "$deleted", "on_cal": "$on_cal"}, "count": {"$sum": 1}, "bytes": {"$sum": "$size"}}}
+        ]
+        stats = {"total": 0, "dashboard": 0, "calendar": 0, "trash": 0, "notes_bytes": 0}
+        for row in self.notes.aggregate(pipeline):
+            stats["total"] += row["count"]
+            stats["notes_bytes"] += row["bytes"]
+            if row["_id"]["deleted"]: stats["trash"] += row["count"]
+            elif row["_id"]["on_cal"]: stats["calendar"] += row["count"]
+            else: stats["dashboard"] += row["count"]
+        try:
+            self._count_trip()
+            stats["storage_bytes"] = self.db.command("dbStats")["dataSize"]
+        except PyMongoError:
+            blob_bytes = next(self.blobs.files.aggregate([{"$group": {"_id": None, "bytes": {"$sum": "$length"}}}]), {}).get("bytes", 0)
+            stats["storage_bytes"] = stats["notes_bytes"] + blob_bytes
+        return stats
+
+    # --- WRITES ---
+
+    # 'file' is an uploaded file or raw bytes; it goes to the blob store, the note keeps its hash.
+    # Images also get a thumbnail blob, so lists never need the full file.
+    def _attach(self, fields, file, file_name):
+        fields["file_id"] = self.blobs.put(file)
+        thumb = make_thumbnail(file)
+        fields["thumb_id"] = self.blobs.put(thumb) if thumb else None
+        fields["file_size"] = len(file) if isinstance(file, (bytes, bytearray)) else file.size
+        fields["file_name"] = file_name
+
+    @action(writes=True)
+    def create_note(self, doc, file=None, file_name=None):
+        doc = dict(doc, custom_order=self._next_order(), pinned=bool(doc.get("pinned")))
+        if file is not None: self._attach(doc, file, file_name)
+        doc.update(search_fields(doc.get("titolo"), doc.get("contenuto"), doc.get("labels")))
+        self.notes.insert_one(doc)
+        return doc["_id"]
+
+    @action(writes=True)
+    def update_note(self, note_id, fields, file=None, file_name=None, date_ref=None):
+        fields = dict(fields)
+        if file is not None: self._attach(fields, file, file_name)
+        if "titolo" in fields:
+            fields.update(search_fields(fields["titolo"], fields.get("contenuto"), fields.get("labels")))
+        update = {"$set": fields, "$unset": {"fingerprint": ""}}
+        if is_virtual_note(note_id):
+            # First edit of a virtual day note: this is where it gets written.
+            # A trashed copy under the same id is brought back rather than edited out of sight.
+            fields["deleted"] = False
+            update["$unset"]["deleted_at"] = ""
+            update["$setOnInsert"] = {k: v for k, v in virtual_day_note(date_ref).items() if k not in ("_id", "is_virtual") and k not in fields}
+        old = self.notes.find_one_and_update({"_id": note_id}, update, projection={"file_id": 1, "thumb_id": 1}, upsert=is_virtual_note(note_id))
+        if old and old.get("file_id") != fields.get("file_id", old.get("file_id")):
+            self.blobs.delete_unreferenced(self.notes, [old.get("file_id"), old.get("thumb_id")])
+
+    @action(writes=True)
+    def remove_file(self, note_id):
+        update = {"$set": {"file_name": None, "file_id": None, "thumb_id": None, "file_size": 0, "data": datetime.now()}, "$unset": {"fingerprint": ""}}
+        old = self.notes.find_one_and_update({"_id": note_id}, update, projection={"file_id": 1, "thumb_id": 1})
+        if old: self.blobs.delete_unreferenced(self.notes, [old.get("file_id"), old.get("thumb_id")])
+
+    @action(writes=True)
+    def set_pinned(self, note_id, pinned):
+        self.notes.update_one({"_id": note_id}, {"$set": {"pinned": bool(pinned)}})
+
+    @action(writes=True)
+    def move_to_trash(self, note_id):
+        # deleted_at, not the last-edit 'data', is what the trash retention counts from
+        self.notes.update_one({"_id": note_id}, {"$set": {"deleted": True, "deleted_at": datetime.now()}})
+
+    @action(writes=True)
+    def restore_from_trash(self, note_id):
+        self.notes.update_one({"_id": note_id}, {"$set": {"deleted": False}, "$unset": {"deleted_at": ""}})
+
+    @action(writes=True)
+    def delete_note(self, note_id):
+        return self._purge({"_id": note_id})
+
+    @action(writes=True)
+    def empty_trash(self, calendar):
+        return self._purge({"deleted": True, "calendar_date": {"$ne": None} if calendar else None})
+
+    @action(writes=True)
+    def purge_trash_older_than(self, limit):
+        return self._purge({"deleted": True, "deleted_at": {"$lt": limit}})
+
+    # Blobs kept back from collection because an upload reused them (see blobstore.py)
+    @action
+    def sweep_blobs(self):
+        return self.blobs.sweep_orphans(self.notes)
+
+    # Trash auto-clean is a database setting, since the purge runs in the background for every session
+    @action
+    def trash_auto_clean(self):
+        self._count_trip()
+        doc = self.db.meta.find_one({"_id": SETTINGS_DOC_ID}, {"auto_clean": 1}) or {}
+        return doc.get("auto_clean", True)
+
+    @action
+    def set_trash_auto_clean(self, enabled):
+        self._count_trip()
+        self.db.meta.update_one({"_id": SETTINGS_DOC_ID}, {"$set": {"auto_clean": enabled}}, upsert=True)
+
+    @action(writes=True)
+    def swap_positions(self, note_id, other_id):
+        pair = sorted(self.notes.find({"_id": {"$in": [note_id, other_id]}}, {"custom_order": 1, "pinned": 1}), key=lambda n: n["_id"] != note_id)
+        # Either note may be gone (deleted in another tab): then nothing moves
+        if len(pair) < 2: return
+        n1, n2 = pair
+        # Both notes change or neither does
+        self._atomic([
+            UpdateOne({"_id": note_id}, {"$set": {"custom_order": n2["custom_order"], "pinned": n2.get("pinned", False)}}),
+            UpdateOne({"_id": other_id}, {"$set": {"custom_order": n1["custom_order"], "pinned": n1.get("pinned", False)}}),
+        ])
+
+    @action(writes=True)
+    def insert_before(self, note_id, target_id):
+        target = self.notes.find_one({"_id": target_id}, {"custom_order": 1, "pinned": 1})
+        if target is None: return
+        move_before(self.notes, DASHBOARD_SCOPE, target, note_id, {"pinned": target.get("pinned", False)}, on_rebalance=self.bump_generation)
+
+    @action(writes=True)
+    def duplicate_note(self, note_id):
+        new_doc = self.notes.find_one({"_id": note_id})
+        del new_doc['_id']
+        new_doc.pop('fingerprint', None)
+        new_doc['titolo'] = f"{new_doc['titolo']} (Copy)"
+        new_doc['data'] = datetime.now()
+        # Append to end
+        return self.create_note(new_doc)
+
+    # Drops one occurrence of a recurring note
+    @action(writes=True)
+    def skip_occurrence(self, note_id, date_str):
+        self.notes.update_one({"_id": note_id}, {"$addToSet": {"recur_exdates": date_str}, "$unset": {"fingerprint": ""}})
+
+    @action(writes=True)
+    def move_to_date(self, note_id, current_date_str, target_date_str):
+        if not is_virtual_note(note_id):
+            fields = {"calendar_date": target_date_str}
+            # A series moves as a whole: its rule is re-anchored on the new first date
+            note = self.notes.find_one({"_id": note_id}, {"calendar_date": 1, **{f: 1 for f in RULE_FIELDS}})
+            if note and note.get("recurrence"): fields.update(reanchor(note, target_date_str))
+            self.notes.update_one({"_id": note_id}, {"$set": fields, "$unset": {"fingerprint": ""}})
+            return
+        # A day note's _id belongs to its date, so it moves as a new document
+        new_doc = self.notes.find_one({"_id": note_id}) or virtual_day_note(current_date_str)
+        del new_doc['_id']
+        new_doc.pop('is_virtual', None)
+        new_doc['calendar_date'] = target_date_str
+        self.notes.bulk_write([InsertOne(new_doc), DeleteOne({"_id": note_id})])
+
+    @action(writes=True)
+    def copy_to_date(self, note_id, current_date_str, target_date_str):
+        new_doc = self.notes.find_one({"_id": note_id}) or virtual_day_note(current_date_str)
+        del new_doc['_id']
+        new_doc.pop('is_virtual', None)
+        new_doc.pop('fingerprint', None)
+        if new_doc.get('recurrence'): new_doc.update(reanchor(new_doc, target_date_str))
+        new_doc['calendar_date'] = target_date_str
+        new_doc['data'] = datetime.now()
+        if new_doc.get('is_default'):
+            new_doc['is_default'] = False # Copy is not default
+            new_doc['titolo'] = f"Copy of {new_doc['titolo']}"
+            new_doc.update(search_fields(new_doc['titolo'], new_doc.get('contenuto'), new_doc.get('labels')))
+        self.notes.insert_one(new_doc)
+
+    # --- BACKUP ---
+
+    @action
+    def export_backup(self, include_files=True):
+        return build_backup(self.notes, self.blobs, include_files)
+
+    @action(writes=True)
+    def import_backup(self, fileobj, progress=None):
+        return restore_backup(
+            self.notes, self.blobs, fileobj, progress=progress,
+            prepare=lambda n: n.update(search_fields(n.get("titolo"), n.get("contenuto"), n.get("labels")))
+        )
@@ -0,0 +1,97 @@
+import html
+import re
+import unicodedata
+from pymongo import UpdateOne
+
+# In-app inverted index: every note stores the plain text of its content
+# ('search_text') and the set of normalised words of title, labels and text
+# ('search_terms'). The multikey index on 'search_terms' serves both exact
+# words and anchored prefixes, so a lookup never reads notes that don't match.
+
+TAG_RE = re.compile(r"<[^>]+>")
+SPACE_RE = re.compile(r"\s+")
+WORD_RE = re.compile(r"\w+")
+
+TITLE_WEIGHT = 3
+LABEL_WEIGHT = 2
+TEXT_WEIGHT = 1
+MAX_TEXT_HITS = 5
+
+
+def html_to_text(html_content):
+    if not html_content: return ""
+    text = TAG_RE.sub(" ", html_content)
+    return SPACE_RE.sub(" ", html.unescape(text)).strip()
+
+
+def tokenize(text):
+    if not text: return []
+    # Lowercase and fold accents so "perché" is found by "perche"
+    folded = unicodedata.normalize("NFKD", text.lower())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return WORD_RE.findall(folded)
+
+
+def search_fields(title, content, labels):
+    text = html_to_text(content)
+    terms = set(tokenize(title)) | set(tokenize(text))
+    for label in labels or []:
+        terms.update(tokenize(label))
+    return {"search_text": text, "search_terms": sorted(terms)}
+
+
+def build_search_filter(query):
+    tokens = tokenize(query)
+    if not tokens: return {}
+    # Every word must match exactly, except the last one which is matched as a prefix
+    # (the user may still be typing it). Tokens are \w-only, but escape anyway.
+    clauses = [{"search_terms": tok} for tok in tokens[:-1]]
+    clauses.append({"search_terms": {"$regex": f"^{re.escape(tokens[-1])}"}})
+    return {"$and": clauses}
+
+
+def build_fts_query(query):
+    # Same matching rules for the SQLite backend, as an FTS5 MATCH expression
+    tokens = tokenize(query)
+    if not tokens: return None
+    return " ".join(f'"{tok}"' for tok in tokens[:-1]) + (" " if len(tokens) > 1 else "") + f'"{tokens[-1]}"*'
+
+
+def _hits(words, term, is_prefix):
+    if is_prefix: return sum(1 for w in words if w.startswith(term))
+    return sum(1 for w in words if w == term)
+
+
+def score_note(note, query_tokens):
+    title_words = tokenize(note.get("titolo"))
+    label_words = [w for label in note.get("labels", []) for w in tokenize(label)]
+    text_words = tokenize(note.get("search_text") or html_to_text(note.get("contenuto")))
+    score = 0
+    for i, term in enumerate(query_tokens):
+        is_prefix = i == len(query_tokens) - 1
+        if _hits(title_words, term, is_prefix): score += TITLE_WEIGHT
+        if _hits(label_words, term, is_prefix): score += LABEL_WEIGHT
+        score += TEXT_WEIGHT * min(_hits(text_words, term, is_prefix), MAX_TEXT_HITS)
+    return score
+
+
+def rank_notes(notes, query):
+    query_tokens = tokenize(query)
+    if not query_tokens: return notes
+    # Stable sort: equal scores keep their custom_order
+    return sorted(notes, key=lambda n: -score_note(n, query_tokens))
+
+
+# One-time fill of the search fields for notes saved before search existed
+def backfill_search_fields(collection, batch_size=200):
+    updated, ops = 0, []
+    cursor = collection.find({"search_terms": {"$exists": False}}, {"titolo": 1, "contenuto": 1, "labels": 1}).batch_size(batch_size)
+    for note in cursor:
+        fields = search_fields(note.get("titolo"), note.get("contenuto"), note.get("labels"))
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": fields}))
+        updated += 1
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
+    return updated
@@ -0,0 +1,585 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+import perf
+from backup import DERIVED_FIELDS, note_fingerprint, restore_notes, spool_backup, write_archive
+from blobstore import CHUNK_SIZE, iter_source
+from ranks import MIN_GAP, rank_between
+from recurrence import expand, reanchor
+from repository import DASHBOARD_PAGE_SIZE, TRASH_PAGE_SIZE, RepositoryBase, action, is_virtual_note, virtual_day_note
+from search import build_fts_query, html_to_text
+from thumbnails import make_thumbnail
+
+log = logging.getLogger(__name__)
+
+# Embedded storage backend: the same note operations as NoteRepository, on one
+# SQLite file. A note is a JSON document plus the columns its queries filter and
+# sort on; search goes through an FTS5 table (its rowid kept in notes.fts_id, so a
+# note's row is replaced by rowid, not found by a scan), recurring series through
+# note_months (one row per month a series can fall in), blobs live in 'blobs'.
+# WAL mode lets readers in other sessions run while a write is in progress.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id TEXT PRIMARY KEY,
+    doc TEXT NOT NULL,
+    data TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    deleted_at TEXT,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    custom_order REAL,
+    calendar_date TEXT,
+    recurring INTEGER NOT NULL DEFAULT 0,
+    recur_until TEXT,
+    file_id TEXT,
+    thumb_id TEXT,
+    fingerprint TEXT,
+    drawing_json TEXT,
+    fts_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS notes_dash ON notes(pinned, custom_order, id) WHERE deleted = 0 AND calendar_date IS NULL;
+CREATE INDEX IF NOT EXISTS notes_order ON notes(custom_order);
+CREATE INDEX IF NOT EXISTS notes_cal ON notes(calendar_date) WHERE deleted = 0 AND recurring = 0;
+CREATE INDEX IF NOT EXISTS notes_trash_page ON notes(calendar_date, deleted_at, id) WHERE deleted = 1;
+CREATE INDEX IF NOT EXISTS notes_expiry ON notes(deleted_at) WHERE deleted = 1;
+CREATE INDEX IF NOT EXISTS notes_fingerprint ON notes(fingerprint);
+CREATE INDEX IF NOT EXISTS notes_file ON notes(file_id) WHERE file_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS notes_thumb ON notes(thumb_id) WHERE thumb_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS note_months (
+    month INTEGER NOT NULL,
+    note_id TEXT NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+    PRIMARY KEY (month, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS note_months_note ON note_months(note_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    note_id UNINDEXED, titolo, labels, body, tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+# Fixed width, so timestamps compare correctly as text
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+COLUMNS = ("deleted", "deleted_at", "pinned", "custom_order", "calendar_date", "recur_until", "file_id", "thumb_id", "fingerprint", "drawing_json")
+NOT_STORED = ("_id", "data", "search_text", "search_terms", "is_virtual")
+SUMMARY_COLUMNS = "id, doc, data, deleted, deleted_at, pinned, custom_order, calendar_date, recur_until, file_id, thumb_id"
+# Month grid cells: no content
+GRID_COLUMNS = SUMMARY_COLUMNS.replace("doc", "json_remove(doc, '$.contenuto') AS doc")
+# Trash rows: titles and dates only
+TRASH_COLUMNS = ("id, json_object('titolo', json_extract(doc, '$.titolo'), 'tipo', json_extract(doc, '$.tipo'), "
+                 "'file_name', json_extract(doc, '$.file_name')) AS doc, data, deleted_at, calendar_date")
+DASHBOARD_WHERE = "deleted = 0 AND calendar_date IS NULL"
+# bm25 column weights (note_id, titolo, labels, body), as in search.score_note
+FTS_RANK = "bm25(notes_fts, 0.0, 3.0, 2.0, 1.0)"
+
+
+def _statement(sql):
+    return "sql " + sql.lstrip().split(None, 1)[0].lower()
+
+
+def _row_size(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row if v is not None)
+
+
+def _from_row(row):
+    note = json.loads(row["doc"])
+    note["_id"] = row["id"]
+    note["data"] = datetime.strptime(row["data"], DATE_FORMAT)
+    for col in row.keys():
+        if col in ("id", "doc", "data", "fts_id"): continue
+        note[col] = bool(row[col]) if col in ("deleted", "pinned") else row[col]
+    if note.get("deleted_at"): note["deleted_at"] = datetime.strptime(note["deleted_at"], DATE_FORMAT)
+    return note
+
+
+class SQLiteBlobStore:
+    # Content-addressed like BlobStore: one row per SHA-256
+    def __init__(self, repo):
+        self._repo = repo
+
+    def hash(self, source):
+        digest = hashlib.sha256()
+        for piece in iter_source(source):
+            digest.update(piece)
+        return digest.hexdigest()
+
+    def exists(self, blob_id):
+        return self._repo._query_one("SELECT 1 FROM blobs WHERE id = ?", (blob_id,)) is not None
+
+    def put(self, source):
+        data = b"".join(iter_source(source))
+        blob_id = hashlib.sha256(data).hexdigest()
+        self._repo._execute("INSERT OR IGNORE INTO blobs (id, length, data) VALUES (?, ?, ?)", (blob_id, len(data), data))
+        return blob_id
+
+    def put_stream(self, blob_id, stream):
+        if self.exists(blob_id): return blob_id
+        data = stream.read()
+        if hashlib.sha256(data).hexdigest() != blob_id: raise ValueError(f"Blob content does not match its id {blob_id}")
+        self._repo._execute("INSERT OR IGNORE INTO blobs (id, length, data) VALUES (?, ?, ?)", (blob_id, len(data), data))
+        return blob_id
+
+    def read(self, blob_id):
+        if not blob_id: return None
+        row = self._repo._query_one("SELECT data FROM blobs WHERE id = ?", (blob_id,))
+        return bytes(row["data"]) if row else b""
+
+    def iter_chunks(self, blob_id):
+        data = self.read(blob_id) or b""
+        for i in range(0, len(data), CHUNK_SIZE):
+            yield data[i:i + CHUNK_SIZE]
+
+    def delete_unreferenced(self, blob_ids):
+        for blob_id in set(b for b in blob_ids if b):
+            self._repo._execute(
+                "DELETE FROM blobs WHERE id = ? AND NOT EXISTS (SELECT 1 FROM notes WHERE file_id = ? OR thumb_id = ?)",
+                (blob_id, blob_id, blob_id))
+
+
+class SQLiteNoteRepository(RepositoryBase):
+    # Connections are per thread (sessions and write workers each get their own);
+    # the path must be a file, not ':memory:', for them to share the data.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.blobs = SQLiteBlobStore(self)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _execute(self, sql, params=()):
+        self._count_trip()
+        perf.record_op(_statement(sql), len(sql))
+        return self._conn().execute(sql, params)
+
+    def _executemany(self, sql, rows):
+        self._count_trip()
+        perf.record_op(_statement(sql), len(sql))
+        return self._conn().executemany(sql, rows)
+
+    def _query(self, sql, params=()):
+        rows = self._execute(sql, params).fetchall()
+        if perf.current(): perf.record_op(_statement(sql), received=sum(map(_row_size, rows)), calls=0)
+        return rows
+
+    def _query_one(self, sql, params=()):
+        row = self._execute(sql, params).fetchone()
+        if row is not None and perf.current(): perf.record_op(_statement(sql), received=_row_size(row), calls=0)
+        return row
+
+    @contextmanager
+    def _transaction(self):
+        # Nested calls (duplicate_note -> create_note) join the outer transaction
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try: yield
+            finally: self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def _notes(self, sql, params=()):
+        return [_from_row(row) for row in self._query(sql, params)]
+
+    def _load(self, note_id):
+        row = self._query_one("SELECT * FROM notes WHERE id = ?", (note_id,))
+        return _from_row(row) if row else None
+
+    def _write(self, note_id, note, fingerprint=None):
+        # Whole-note upsert, keeping the FTS row and the series months in step
+        data = note.get("data")
+        note = {k: v for k, v in note.items() if k not in NOT_STORED}
+        note["fingerprint"] = fingerprint or note_fingerprint(dict(note, data=data))
+        cols = {c: note.pop(c, None) for c in COLUMNS}
+        cols["deleted"], cols["pinned"] = int(bool(cols["deleted"])), int(bool(cols["pinned"]))
+        cols["deleted_at"] = cols["deleted_at"].strftime(DATE_FORMAT) if cols["deleted"] and cols["deleted_at"] else None
+        cols["recurring"] = int(bool(note.get("recurrence")))
+        stamp = (data or datetime.now()).strftime(DATE_FORMAT)
+        names = ["id", "doc", "data", *cols]
+        values = [note_id, json.dumps(note, default=str, ensure_ascii=False), stamp, *cols.values()]
+        updates = ", ".join(f"{n} = excluded.{n}" for n in names[1:])
+        self._execute(f"INSERT INTO notes ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) ON CONFLICT(id) DO UPDATE SET {updates}", values)
+        fts_id = self._query_one("SELECT fts_id FROM notes WHERE id = ?", (note_id,))["fts_id"]
+        if fts_id is not None: self._execute("DELETE FROM notes_fts WHERE rowid = ?", (fts_id,))
+        fts_id = self._execute("INSERT INTO notes_fts (rowid, note_id, titolo, labels, body) VALUES (?, ?, ?, ?, ?)",
+                               (fts_id, note_id, note.get("titolo") or "", " ".join(note.get("labels") or []), html_to_text(note.get("contenuto")))).lastrowid
+        self._execute("UPDATE notes SET fts_id = ? WHERE id = ?", (fts_id, note_id))
+        self._execute("DELETE FROM note_months WHERE note_id = ?", (note_id,))
+        if cols["recurring"]:
+            self._executemany("INSERT INTO note_months (month, note_id) VALUES (?, ?)", [(m, note_id) for m in note.get("recur_months") or range(1, 13)])
+
+    def _modify(self, note_id, change):
+        # Read-modify-write of one note; change(note) edits it in place
+        with self._transaction():
+            note = self._load(note_id)
+            if note is None: return None
+            old = {"file_id": note.get("file_id"), "thumb_id": note.get("thumb_id")}
+            change(note)
+            self._write(note_id, note)
+        return old
+
+    def _next_order(self):
+        row = self._query_one("SELECT MAX(custom_order) AS last FROM notes")
+        return (row["last"] + 1) if row and row["last"] is not None else 0
+
+    def _purge(self, where, params=()):
+        with self._transaction():
+            blob_ids = [b for row in self._query(f"SELECT file_id, thumb_id FROM notes WHERE {where}", params) for b in row]
+            self._execute(f"DELETE FROM notes_fts WHERE rowid IN (SELECT fts_id FROM notes WHERE {where})", params)
+            deleted = self._execute(f"DELETE FROM notes WHERE {where}", params).rowcount
+            self.blobs.delete_unreferenced(blob_ids)
+        return deleted
+
+    def _attach(self, fields, file, file_name):
+        fields["file_id"] = self.blobs.put(file)
+        thumb = make_thumbnail(file)
+        fields["thumb_id"] = self.blobs.put(thumb) if thumb else None
+        fields["file_size"] = len(file) if isinstance(file, (bytes, bytearray)) else file.size
+        fields["file_name"] = file_name
+
+    def _fts_clause(self, query, column="id"):
+        match = build_fts_query(query) if query else None
+        if not match: return "", ()
+        return f" AND {column} IN (SELECT note_id FROM notes_fts WHERE notes_fts MATCH ?)", (match,)
+
+    # --- SETUP ---
+
+    @action(writes=True)
+    def ensure_ready(self):
+        # Files from before deleted_at get the column (trash retention starts now); replaced trash indexes are dropped
+        columns = {row["name"] for row in self._query("PRAGMA table_info(notes)")}
+        if columns and "deleted_at" not in columns:
+            with self._transaction():
+                self._execute("ALTER TABLE notes ADD COLUMN deleted_at TEXT")
+                self._execute("UPDATE notes SET deleted_at = ? WHERE deleted = 1", (datetime.now().strftime(DATE_FORMAT),))
+                self._execute("DROP INDEX IF EXISTS notes_trash")
+        if columns and "fts_id" not in columns:
+            # FTS rows are found by rowid from now on: record each note's, in one pass over notes_fts
+            with self._transaction():
+                self._execute("ALTER TABLE notes ADD COLUMN fts_id INTEGER")
+                self._executemany("UPDATE notes SET fts_id = ? WHERE id = ?",
+                                  [(row["rowid"], row["note_id"]) for row in self._query("SELECT rowid, note_id FROM notes_fts")])
+        self._execute("DROP INDEX IF EXISTS notes_trash_deleted")
+        self._conn().executescript(SCHEMA)
+        self._execute("PRAGMA optimize")
+        return [], []
+
+    # --- READS ---
+
+    @action
+    def dashboard_notes(self, query=None, limit=None):
+        # Ranked by bm25 inside SQLite; only the first 'limit' rows are read (-1: no limit)
+        match = build_fts_query(query) if query else None
+        if not match:
+            return self._notes(f"SELECT {SUMMARY_COLUMNS} FROM notes WHERE {DASHBOARD_WHERE} ORDER BY custom_order LIMIT ?", (limit or -1,))
+        columns = ", ".join(f"n.{c.strip()}" for c in SUMMARY_COLUMNS.split(","))
+        return self._notes(
+            f"SELECT {columns} FROM notes_fts JOIN notes n ON n.id = notes_fts.note_id "
+            f"WHERE notes_fts MATCH ? AND n.deleted = 0 AND n.calendar_date IS NULL ORDER BY {FTS_RANK}, n.custom_order LIMIT ?", (match, limit or -1))
+
+    @action
+    def dashboard_page(self, after=None, limit=DASHBOARD_PAGE_SIZE):
+        notes = []
+        for pinned in (True, False):
+            if after and after[0] != pinned: continue
+            sql, params = f"SELECT {SUMMARY_COLUMNS} FROM notes WHERE {DASHBOARD_WHERE} AND pinned = ?", [int(pinned)]
+            if after:
+                _, order, last_id = after
+                sql += " AND (custom_order > ? OR (custom_order = ? AND id > ?))"
+                params += [order, order, last_id]
+                after = None
+            notes += self._notes(sql + " ORDER BY custom_order, id LIMIT ?", params + [limit + 1 - len(notes)])
+            if len(notes) > limit: break
+        if len(notes) <= limit: return notes, None
+        notes = notes[:limit]
+        last = notes[-1]
+        return notes, (bool(last.get("pinned")), last["custom_order"], last["_id"])
+
+    @action
+    def dashboard_candidates(self, exclude_id):
+        rows = self._query(f"SELECT id, json_extract(doc, '$.titolo') AS titolo, pinned FROM notes WHERE {DASHBOARD_WHERE} AND id != ? ORDER BY custom_order", (exclude_id,))
+        return [{"_id": r["id"], "titolo": r["titolo"], "pinned": bool(r["pinned"])} for r in rows]
+
+    @action
+    def month_notes(self, year, month, num_days, query=None, compact=False, first_day=1):
+        # Days first_day..num_days of the month (one day: first_day == num_days)
+        start_date_str = f"{year}-{month:02d}-{first_day:02d}"
+        end_date_str = f"{year}-{month:02d}-{num_days:02d}"
+        columns = GRID_COLUMNS if compact else SUMMARY_COLUMNS
+        search, search_params = self._fts_clause(query)
+        reg = self._notes(
+            f"SELECT {columns} FROM notes WHERE calendar_date BETWEEN ? AND ? AND deleted = 0 AND recurring = 0{search}",
+            (start_date_str, end_date_str, *search_params))
+        series = self._notes(
+            f"SELECT {columns} FROM notes WHERE id IN (SELECT note_id FROM note_months WHERE month = ?) "
+            f"AND calendar_date <= ? AND deleted = 0 AND (recur_until IS NULL OR recur_until >= ?){search}",
+            (month, end_date_str, start_date_str, *search_params))
+        return reg, expand(series, start_date_str, end_date_str)
+
+    @action
+    def trash_count(self, calendar):
+        scope = "calendar_date IS NOT NULL" if calendar else "calendar_date IS NULL"
+        return self._query_one(f"SELECT COUNT(*) FROM notes WHERE deleted = 1 AND {scope}")[0]
+
+    @action
+    def trash_page(self, calendar, after=None, limit=TRASH_PAGE_SIZE):
+        sql = f"SELECT {TRASH_COLUMNS} FROM notes WHERE deleted = 1 AND calendar_date IS {'NOT NULL' if calendar else 'NULL'}"
+        params = []
+        if after:
+            deleted_at, last_id = after
+            sql += " AND (deleted_at < ? OR (deleted_at = ? AND id < ?))"
+            stamp = deleted_at.strftime(DATE_FORMAT)
+            params += [stamp, stamp, last_id]
+        notes = self._notes(sql + " ORDER BY deleted_at DESC, id DESC LIMIT ?", params + [limit + 1])
+        if len(notes) <= limit: return notes, None
+        notes = notes[:limit]
+        return notes, (notes[-1]["deleted_at"], notes[-1]["_id"])
+
+    @action
+    def get_fields(self, note_id, *fields):
+        note = self._load(note_id)
+        if note is None: return {}
+        return {"_id": note_id, **{f: note[f] for f in fields if f in note}}
+
+    @action
+    def read_blob(self, blob_id):
+        return self.blobs.read(blob_id)
+
+    @action
+    def storage_stats(self):
+        stats = {"total": 0, "dashboard": 0, "calendar": 0, "trash": 0, "notes_bytes": 0}
+        rows = self._query(
+            "SELECT deleted, calendar_date IS NOT NULL AS on_cal, COUNT(*) AS count, "
+            "SUM(length(doc) + IFNULL(length(drawing_json), 0)) AS bytes FROM notes GROUP BY 1, 2")
+        for row in rows:
+            stats["total"] += row["count"]
+            stats["notes_bytes"] += row["bytes"] or 0
+            if row["deleted"]: stats["trash"] += row["count"]
+            elif row["on_cal"]: stats["calendar"] += row["count"]
+            else: stats["dashboard"] += row["count"]
+        page_count = self._query_one("PRAGMA page_count")[0]
+        page_size = self._query_one("PRAGMA page_size")[0]
+        stats["storage_bytes"] = page_count * page_size
+        return stats
+
+    # --- WRITES ---
+
+    @action(writes=True)
+    def create_note(self, doc, file=None, file_name=None):
+        doc = dict(doc)
+        if file is not None: self._attach(doc, file, file_name)
+        note_id = uuid.uuid4().hex
+        with self._transaction():
+            doc["custom_order"] = self._next_order()
+            self._write(note_id, doc)
+        return note_id
+
+    @action(writes=True)
+    def update_note(self, note_id, fields, file=None, file_name=None, date_ref=None):
+        fields = dict(fields)
+        if file is not None: self._attach(fields, file, file_name)
+        with self._transaction():
+            note = self._load(note_id)
+            old = {"file_id": note.get("file_id"), "thumb_id": note.get("thumb_id")} if note else None
+            if is_virtual_note(note_id):
+                # First edit of a virtual day note writes it; a trashed copy comes back
+                if note is None: note = {k: v for k, v in virtual_day_note(date_ref).items() if k not in ("_id", "is_virtual")}
+                fields["deleted"] = False
+            if note is None: return
+            note.update(fields)
+            self._write(note_id, note)
+            if old and old["file_id"] != note.get("file_id"):
+                self.blobs.delete_unreferenced([old["file_id"], old["thumb_id"]])
+
+    @action(writes=True)
+    def remove_file(self, note_id):
+        old = self._modify(note_id, lambda n: n.update({"file_name": None, "file_id": None, "thumb_id": None, "file_size": 0, "data": datetime.now()}))
+        if old: self.blobs.delete_unreferenced(old.values())
+
+    @action(writes=True)
+    def set_pinned(self, note_id, pinned):
+        self._execute("UPDATE notes SET pinned = ? WHERE id = ?", (int(bool(pinned)), note_id))
+
+    @action(writes=True)
+    def move_to_trash(self, note_id):
+        self._execute("UPDATE notes SET deleted = 1, deleted_at = ? WHERE id = ?", (datetime.now().strftime(DATE_FORMAT), note_id))
+
+    @action(writes=True)
+    def restore_from_trash(self, note_id):
+        self._execute("UPDATE notes SET deleted = 0, deleted_at = NULL WHERE id = ?", (note_id,))
+
+    @action(writes=True)
+    def delete_note(self, note_id):
+        return self._purge("id = ?", (note_id,))
+
+    @action(writes=True)
+    def empty_trash(self, calendar):
+        return self._purge(f"deleted = 1 AND calendar_date IS {'NOT NULL' if calendar else 'NULL'}")
+
+    @action(writes=True)
+    def purge_trash_older_than(self, limit):
+        return self._purge("deleted = 1 AND deleted_at < ?", (limit.strftime(DATE_FORMAT),))
+
+    # Unreferenced blobs are deleted in a single statement here, nothing is held back
+    @action
+    def sweep_blobs(self):
+        return 0
+
+    @action
+    def trash_auto_clean(self):
+        row = self._query_one("SELECT value FROM meta WHERE key = 'auto_clean'")
+        return row is None or row["value"] == "1"
+
+    @action
+    def set_trash_auto_clean(self, enabled):
+        self._execute("INSERT INTO meta (key, value) VALUES ('auto_clean', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", ("1" if enabled else "0",))
+
+    @action(writes=True)
+    def swap_positions(self, note_id, other_id):
+        with self._transaction():
+            rows = {r["id"]: r for r in self._query("SELECT id, custom_order, pinned FROM notes WHERE id IN (?, ?)", (note_id, other_id))}
+            # Either note may be gone (deleted in another tab): then nothing moves
+            if len(rows) < 2: return
+            n1, n2 = rows[note_id], rows[other_id]
+            self._executemany("UPDATE notes SET custom_order = ?, pinned = ? WHERE id = ?", [
+                (n2["custom_order"], n2["pinned"], note_id),
+                (n1["custom_order"], n1["pinned"], other_id),
+            ])
+
+    def _rebalance(self):
+        ids = [r["id"] for r in self._query(f"SELECT id FROM notes WHERE {DASHBOARD_WHERE} ORDER BY custom_order, id")]
+        self._executemany("UPDATE notes SET custom_order = ? WHERE id = ?", list(enumerate(ids)))
+        log.info("Rebalanced %s ranks", len(ids))
+
+    @action(writes=True)
+    def insert_before(self, note_id, target_id):
+        with self._transaction():
+            for _ in range(2):
+                target = self._query_one("SELECT custom_order, pinned FROM notes WHERE id = ?", (target_id,))
+                if target is None: return
+                prev = self._query_one(
+                    f"SELECT custom_order FROM notes WHERE {DASHBOARD_WHERE} AND custom_order < ? AND id != ? ORDER BY custom_order DESC LIMIT 1",
+                    (target["custom_order"], note_id))
+                prev_rank = prev["custom_order"] if prev else None
+                new_rank = rank_between(prev_rank, target["custom_order"])
+                # Renumbering is a single local transaction here, so it runs inline rather than in the background
+                if prev_rank is None or target["custom_order"] - prev_rank >= MIN_GAP: break
+                self._rebalance()
+            self._execute("UPDATE notes SET custom_order = ?, pinned = ? WHERE id = ?", (new_rank, target["pinned"], note_id))
+
+    @action(writes=True)
+    def duplicate_note(self, note_id):
+        new_doc = self._load(note_id)
+        del new_doc["_id"]
+        new_doc["titolo"] = f"{new_doc['titolo']} (Copy)"
+        new_doc["data"] = datetime.now()
+        return self.create_note(new_doc)
+
+    @action(writes=True)
+    def skip_occurrence(self, note_id, date_str):
+        self._modify(note_id, lambda n: n.update(recur_exdates=sorted(set(n.get("recur_exdates") or []) | {date_str})))
+
+    @action(writes=True)
+    def move_to_date(self, note_id, current_date_str, target_date_str):
+        def move(note):
+            if note.get("recurrence"): note.update(reanchor(note, target_date_str))
+            note["calendar_date"] = target_date_str
+        if not is_virtual_note(note_id):
+            self._modify(note_id, move)
+            return
+        # A day note's _id belongs to its date, so it moves as a new row
+        with self._transaction():
+            new_doc = self._load(note_id) or virtual_day_note(current_date_str)
+            new_doc.pop("_id")
+            new_doc.pop("is_virtual", None)
+            move(new_doc)
+            self._write(uuid.uuid4().hex, new_doc)
+            self._execute("DELETE FROM notes_fts WHERE rowid = (SELECT fts_id FROM notes WHERE id = ?)", (note_id,))
+            self._execute("DELETE FROM notes WHERE id = ?", (note_id,))
+
+    @action(writes=True)
+    def copy_to_date(self, note_id, current_date_str, target_date_str):
+        new_doc = self._load(note_id) or virtual_day_note(current_date_str)
+        new_doc.pop("_id")
+        new_doc.pop("is_virtual", None)
+        if new_doc.get("recurrence"): new_doc.update(reanchor(new_doc, target_date_str))
+        new_doc["calendar_date"] = target_date_str
+        new_doc["data"] = datetime.now()
+        if new_doc.get("is_default"):
+            new_doc["is_default"] = False  # Copy is not default
+            new_doc["titolo"] = f"Copy of {new_doc['titolo']}"
+        self._write(uuid.uuid4().hex, new_doc)
+
+    # --- BACKUP ---
+
+    @action
+    def export_backup(self, include_files=True):
+        def notes():
+            for row in self._query("SELECT * FROM notes"):
+                note = _from_row(row)
+                for field in DERIVED_FIELDS: note.pop(field, None)
+                if not include_files: note.pop("drawing_json", None)
+                yield note
+
+        def blobs():
+            rows = self._query("SELECT id, length FROM blobs WHERE id IN (SELECT file_id FROM notes UNION SELECT thumb_id FROM notes)")
+            for row in rows:
+                yield row["id"], row["length"], self.blobs.iter_chunks(row["id"])
+
+        return spool_backup(lambda out: write_archive(out, notes(), blobs() if include_files else (), include_files))
+
+    @action(writes=True)
+    def import_backup(self, fileobj, progress=None):
+        # backup.restore_notes does the dedupe and blob checks; restored dashboard notes are then
+        # appended after the existing ones in backup order
+        base_order = self._next_order()
+        restored_dash = []
+
+        def known(prints):
+            return {r["fingerprint"] for r in self._query(
+                f"SELECT fingerprint FROM notes WHERE fingerprint IN ({', '.join('?' * len(prints))})", prints)}
+
+        def insert(notes):
+            with self._transaction():
+                for note in notes:
+                    note_id = uuid.uuid4().hex
+                    if note.get("calendar_date") is None:
+                        restored_dash.append((note.get("custom_order") or 0, note["data"], note_id))
+                    # The backup's fingerprint is kept: it was taken before missing blobs were dropped,
+                    # and the next restore of the same backup computes that one
+                    self._write(note_id, note, note["fingerprint"])
+
+        counts = restore_notes(fileobj, self.blobs, known, lambda ids: {b for b in ids if self.blobs.exists(b)}, insert, progress=progress)
+        restored_dash.sort(key=lambda r: (r[0], r[1]))
+        with self._transaction():
+            self._executemany("UPDATE notes SET custom_order = ? WHERE id = ?",
+                              [(base_order + i, note_id) for i, (_, _, note_id) in enumerate(restored_dash)])
+        return counts
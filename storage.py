@@ -0,0 +1,20 @@
+import pymongo
+from perf import CommandMonitor
+from repository import NoteRepository
+from sqlite_repository import SQLiteNoteRepository
+
+# Picks the note storage backend from the app settings (st.secrets as a dict):
+#   [storage] backend = "sqlite", path = "diario.db"   -> embedded SQLite file
+#   [mongo] connection_string = "..."                   -> MongoDB (the default when set)
+# Without either it refuses to start: silently writing to a local file on a host
+# whose secrets are broken could put notes somewhere they will be lost.
+DEFAULT_SQLITE_PATH = "diario.db"
+
+
+def open_repository(settings):
+    storage = settings.get("storage", {})
+    backend = storage.get("backend") or ("mongo" if "mongo" in settings else None)
+    if backend is None: raise ValueError("No storage configured: set [mongo] connection_string or [storage] backend")
+    if backend == "sqlite": return SQLiteNoteRepository(storage.get("path", DEFAULT_SQLITE_PATH))
+    if backend == "mongo": return NoteRepository(pymongo.MongoClient(settings["mongo"]["connection_string"], event_listeners=[CommandMonitor()]).diario_db)
+    raise ValueError(f"Unknown storage backend: {backend}")
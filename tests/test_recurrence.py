@@ -0,0 +1,24 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recurrence import parse_rrule
+
+
+class ParseRruleTest(unittest.TestCase):
+    def test_byday_with_weekly(self):
+        self.assertEqual(parse_rrule("FREQ=WEEKLY;BYDAY=TH,MO;COUNT=10"), {"freq": "weekly", "weekdays": [0, 3], "count": 10})
+
+    def test_byday_rejected_without_weekly(self):
+        with self.assertRaisesRegex(ValueError, "only supported with FREQ=WEEKLY"):
+            parse_rrule("FREQ=MONTHLY;BYDAY=MO")
+
+    def test_unknown_byday_code(self):
+        with self.assertRaisesRegex(ValueError, "Unknown BYDAY code: XX"):
+            parse_rrule("FREQ=WEEKLY;BYDAY=MO,XX")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import io
+from pymongo import UpdateOne
+
+# Downscaled previews for drawings and image attachments, made once at save time
+# and stored as their own blob (note field 'thumb_id'). Lists show the thumbnail;
+# the full image is fetched only when someone asks for it.
+THUMB_MAX_SIDE = 480
+WEBP_QUALITY = 80
+
+
+def make_thumbnail(source):
+    # source: bytes or a seekable file-like object. Returns encoded bytes, or None if it isn't an image.
+    # PIL is imported here, on the first save with a file, rather than at app startup
+    from PIL import Image, UnidentifiedImageError
+    data = io.BytesIO(bytes(source)) if isinstance(source, (bytes, bytearray, memoryview)) else source
+    data.seek(0)
+    try:
+        img = Image.open(data)
+        img.draft("RGB", (THUMB_MAX_SIDE, THUMB_MAX_SIDE))  # JPEG: decode straight at reduced scale
+        img.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+        if img.mode not in ("RGB", "RGBA"): img = img.convert("RGBA" if "transparency" in img.info or "A" in img.mode else "RGB")
+        out = io.BytesIO()
+        try:
+            img.save(out, format="WEBP", quality=WEBP_QUALITY, method=4)
+        except (KeyError, OSError):
+            # Pillow built without WebP support
+            out = io.BytesIO()
+            img.save(out, format="PNG", optimize=True)
+        return out.getvalue()
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+    finally:
+        data.seek(0)
+
+
+# Notes saved before thumbnails existed; notes whose file isn't an image get thumb_id None
+def backfill_thumbnails(collection, store, batch_size=50):
+    made, ops = 0, []
+    cursor = collection.find({"file_id": {"$nin": [None, ""]}, "thumb_id": {"$exists": False}}, {"file_id": 1}).batch_size(batch_size)
+    for note in cursor:
+        thumb = make_thumbnail(store.read(note["file_id"]) or b"")
+        thumb_id = store.put(thumb) if thumb else None
+        if thumb_id: made += 1
+        ops.append(UpdateOne({"_id": note["_id"]}, {"$set": {"thumb_id": thumb_id}}))
+        if len(ops) >= batch_size:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops: collection.bulk_write(ops, ordered=False)
+    return made
@@ -0,0 +1,46 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+# Trash retention. Notes in the trash are purged TRASH_RETENTION_DAYS after their
+# deleted_at by one background thread per process, not by requests. The purge
+# goes through the same repository path as "Empty Trash", so attachment and
+# thumbnail blobs no longer referenced are removed with the notes. It is chosen
+# over a Mongo TTL index for that reason: a TTL delete would leave blobs behind,
+# and it works the same on the SQLite backend.
+TRASH_RETENTION_DAYS = 30
+PURGE_INTERVAL = 60 * 60
+
+# One purger per process, bound to the repository it was started for. A new repository
+# (st.cache_resource cleared, backend changed) replaces it and the old thread stops.
+_purger_lock = threading.Lock()
+_purger = None  # (repo, stop event)
+
+
+def purge_expired(repo, days=TRASH_RETENTION_DAYS):
+    # Returns how many notes were removed; nothing when auto-clean is off
+    if not repo.trash_auto_clean(): return 0
+    return repo.purge_trash_older_than(datetime.now() - timedelta(days=days))
+
+
+def _purge_loop(repo, interval, stop):
+    while not stop.is_set():
+        try:
+            purged = purge_expired(repo)
+            if purged: log.info("Purged %s expired trash notes", purged)
+            repo.sweep_blobs()
+        except Exception:
+            log.exception("Trash purge failed")
+        stop.wait(interval)
+
+
+def start_purger(repo, interval=PURGE_INTERVAL):
+    global _purger
+    with _purger_lock:
+        if _purger and _purger[0] is repo: return
+        if _purger: _purger[1].set()
+        stop = threading.Event()
+        _purger = (repo, stop)
+    threading.Thread(target=_purge_loop, args=(repo, interval, stop), daemon=True, name="trash-purger").start()
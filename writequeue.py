@@ -0,0 +1,24 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Background writes: saves that carry a file (uploads, drawings) are handed to a
+# small shared pool, so the session that made them keeps running while the blob
+# is hashed, chunked and written. Callers keep the Future and report its outcome.
+WRITE_WORKERS = 2
+
+# Shared by all sessions: app.py is re-run on every interaction, this module is not
+_pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix="write")
+
+
+def _run(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        log.exception("Background write %s failed", getattr(fn, "__name__", fn))
+        raise
+
+
+def submit(fn, *args, **kwargs):
+    return _pool.submit(_run, fn, args, kwargs)